@@ -0,0 +1,281 @@
+"""
+Index de plus proches voisins approché (IVF, avec codes PQ optionnels) sur les embeddings normalisés
+
+L'index est construit hors ligne à partir des artefacts colonnaires (voir convert_artifacts.py) et
+enregistré dans le même dossier de version. Au démarrage, function_app.py le charge en mémoire mappée
+et l'utilise pour le calcul des recommandations en ligne :
+    - IVF : les articles sont répartis en n_lists groupes par k-means sphérique ; une requête ne
+      parcourt que les nprobe groupes dont le centroïde est le plus proche du profil utilisateur.
+    - PQ (optionnel) : chaque vecteur est découpé en pq_subspaces sous-vecteurs codés sur un octet ;
+      les candidats sont pré-classés avec ces codes puis les meilleurs sont re-classés exactement.
+
+Construction et vérification du rappel par rapport à la recherche exacte :
+    python ann_index.py build artifacts/ --n-lists 1024 --pq-subspaces 0
+    python ann_index.py recall artifacts/ --nprobe 8 --k 5
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+ANN_PREFIX = "ann"
+PQ_CENTROIDS = 256  # Codes PQ sur un octet
+INT8_SCALE = 127.0  # Embeddings normalisés quantifiés sur int8 : composantes de [-1, 1] codées dans [-127, 127]
+
+
+# Fonction pour convertir des embeddings normalisés dans le type de stockage choisi (float32, float16 ou int8)
+def quantize_embeddings(embeddings_norm, dtype):
+    dtype = np.dtype(dtype)
+    if dtype == np.int8:
+        return np.round(np.clip(embeddings_norm, -1.0, 1.0) * INT8_SCALE).astype(np.int8)
+    return np.asarray(embeddings_norm, dtype=dtype)
+
+# Fonction pour lire des lignes d'embeddings en float32, quel que soit le type de stockage
+def embedding_rows(embeddings_norm, ids):
+    rows = np.asarray(embeddings_norm[ids], dtype=np.float32)
+    return rows / INT8_SCALE if embeddings_norm.dtype == np.int8 else rows
+
+# Fonction pour calculer embeddings_norm @ query. Hors float32, la matrice est convertie par blocs de lignes :
+# la mémoire temporaire reste bornée à block_size lignes en float32
+def embedding_dot(embeddings_norm, query, block_size=65536):
+    if embeddings_norm.dtype == np.float32:
+        return embeddings_norm @ query
+    query = np.asarray(query, dtype=np.float32)
+    scores = np.empty((len(embeddings_norm),) + query.shape[1:], dtype=np.float32)
+    for start in range(0, len(embeddings_norm), block_size):
+        scores[start:start + block_size] = embedding_rows(embeddings_norm, slice(start, start + block_size)) @ query
+    return scores
+
+# Fonction pour calculer un k-means (sphérique : produit scalaire sur vecteurs normalisés, sinon euclidien)
+def kmeans(vectors, n_clusters, n_iter=20, spherical=True, seed=0):
+    rng = np.random.default_rng(seed)
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_clusters(vectors, centroids, spherical)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Les groupes vides sont ré-initialisés sur des points tirés au hasard
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        if spherical:
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            centroids /= np.where(norms == 0, 1.0, norms)
+    return centroids
+
+# Fonction pour affecter chaque vecteur au centroïde le plus proche (par blocs pour borner la mémoire)
+def assign_clusters(vectors, centroids, spherical=True, block_size=65536):
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        products = block @ centroids.T
+        if spherical:
+            assignments[start:start + block_size] = products.argmax(axis=1)
+        else:
+            assignments[start:start + block_size] = (centroid_norms - 2 * products).argmin(axis=1)
+    return assignments
+
+
+class IvfIndex:
+    def __init__(self, centroids, list_offsets, list_ids, pq_codebooks=None, pq_codes=None):
+        self.centroids = centroids          # (n_lists, d) centroïdes normalisés
+        self.list_offsets = list_offsets    # (n_lists + 1,) offsets des groupes dans list_ids
+        self.list_ids = list_ids            # ids d'articles triés par groupe
+        self.pq_codebooks = pq_codebooks    # (pq_subspaces, 256, d / pq_subspaces) ou None
+        self.pq_codes = pq_codes            # (n_articles, pq_subspaces) uint8, indexé par id d'article, ou None
+        self.extra_lists = {}               # Articles ajoutés depuis la construction : groupe -> [ids]
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @property
+    def pq_subspaces(self):
+        return 0 if self.pq_codebooks is None else len(self.pq_codebooks)
+
+    @classmethod
+    def build(cls, embeddings_norm, n_lists, pq_subspaces=0, n_iter=20, sample_size=100_000, seed=0):
+        rng = np.random.default_rng(seed)
+        embeddings_norm = np.asarray(embeddings_norm, dtype=np.float32)
+        sample = embeddings_norm[rng.choice(len(embeddings_norm), min(sample_size, len(embeddings_norm)), replace=False)]
+
+        centroids = kmeans(sample, n_lists, n_iter=n_iter, spherical=True, seed=seed)
+        assignments = assign_clusters(embeddings_norm, centroids, spherical=True)
+        list_ids = np.argsort(assignments, kind="stable").astype(np.int32)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(centroids)))]).astype(np.int64)
+
+        pq_codebooks = pq_codes = None
+        if pq_subspaces:
+            dim = embeddings_norm.shape[1]
+            if dim % pq_subspaces:
+                raise ValueError(f"La dimension {dim} n'est pas divisible par pq_subspaces={pq_subspaces}")
+            sub_dim = dim // pq_subspaces
+            pq_codebooks = np.empty((pq_subspaces, PQ_CENTROIDS, sub_dim), dtype=np.float32)
+            pq_codes = np.empty((len(embeddings_norm), pq_subspaces), dtype=np.uint8)
+            for m in range(pq_subspaces):
+                part = slice(m * sub_dim, (m + 1) * sub_dim)
+                codebook = kmeans(sample[:, part], PQ_CENTROIDS, n_iter=n_iter, spherical=False, seed=seed + m)
+                pq_codebooks[m, :len(codebook)] = codebook
+                pq_codebooks[m, len(codebook):] = codebook[0]
+                pq_codes[:, m] = assign_clusters(embeddings_norm[:, part], codebook, spherical=False)
+        return cls(centroids, list_offsets, list_ids, pq_codebooks, pq_codes)
+
+    # Fonction pour enregistrer l'index dans un dossier (écriture via fichier temporaire puis os.replace)
+    def save(self, directory):
+        arrays = {"centroids": self.centroids, "list_offsets": self.list_offsets, "list_ids": self.list_ids}
+        if self.pq_codebooks is not None:
+            arrays.update(pq_codebooks=self.pq_codebooks, pq_codes=self.pq_codes)
+        for name, values in arrays.items():
+            path = os.path.join(directory, f"{ANN_PREFIX}_{name}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(values), allow_pickle=False)
+            os.replace(path + ".tmp", path)
+        return {"n_lists": self.n_lists, "pq_subspaces": self.pq_subspaces}
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        def array(name):
+            return np.load(os.path.join(directory, f"{ANN_PREFIX}_{name}.npy"), mmap_mode=mmap_mode, allow_pickle=False)
+
+        pq = os.path.exists(os.path.join(directory, f"{ANN_PREFIX}_pq_codebooks.npy"))
+        return cls(np.asarray(array("centroids")), array("list_offsets"), array("list_ids"),
+                   np.asarray(array("pq_codebooks")) if pq else None, array("pq_codes") if pq else None)
+
+    # Fonction pour ajouter (ou déplacer) des articles sans reconstruire l'index : chaque vecteur est
+    # rangé dans le groupe de son centroïde le plus proche. Coût proportionnel au nombre d'articles ajoutés.
+    def add(self, ids, vectors):
+        assignments = assign_clusters(np.asarray(vectors, dtype=np.float32), self.centroids, spherical=True)
+        for list_id, article_id in zip(assignments.tolist(), ids):
+            self.extra_lists.setdefault(list_id, []).append(int(article_id))
+
+    # Fonction pour obtenir une copie de l'index avec des articles ajoutés (l'index d'origine n'est pas modifié)
+    def with_added(self, ids, vectors):
+        index = IvfIndex(self.centroids, self.list_offsets, self.list_ids, self.pq_codebooks, self.pq_codes)
+        index.extra_lists = {list_id: list(ids) for list_id, ids in self.extra_lists.items()}
+        index.add(ids, vectors)
+        return index
+
+    # Fonction pour produire un index où les articles ajoutés sont intégrés aux groupes (compaction)
+    def merged(self, embeddings_norm):
+        if not self.extra_lists:
+            return self
+        extra_ids = np.array([i for ids in self.extra_lists.values() for i in ids], dtype=np.int64)
+        # -1 : ligne rangée dans aucun groupe (ligne nulle laissée par un article_id ingéré au-delà de la matrice)
+        assignments = np.full(len(embeddings_norm), -1, dtype=np.int64)
+        assignments[self.list_ids] = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        for list_id, ids in self.extra_lists.items():
+            assignments[ids] = list_id
+        assigned = np.flatnonzero(assignments >= 0)
+        list_ids = assigned[np.argsort(assignments[assigned], kind="stable")].astype(np.int32)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments[assigned], minlength=self.n_lists))]).astype(np.int64)
+
+        pq_codes = None
+        if self.pq_codebooks is not None:
+            pq_codes = np.zeros((len(embeddings_norm), self.pq_subspaces), dtype=np.uint8)
+            pq_codes[:len(self.pq_codes)] = self.pq_codes
+            sub_dim = self.pq_codebooks.shape[2]
+            for m in range(self.pq_subspaces):
+                part = embedding_rows(embeddings_norm, extra_ids)[:, m * sub_dim:(m + 1) * sub_dim]
+                pq_codes[extra_ids, m] = assign_clusters(part, self.pq_codebooks[m], spherical=False)
+        return IvfIndex(self.centroids, list_offsets, list_ids, self.pq_codebooks, pq_codes)
+
+    # Fonction pour récupérer les ids d'articles des nprobe groupes les plus proches de la requête
+    def candidates(self, query, nprobe):
+        nprobe = min(nprobe, self.n_lists)
+        probed = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        lists = [self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed]
+        if not self.extra_lists:
+            return np.concatenate(lists)
+        lists += [np.asarray(self.extra_lists[i], dtype=self.list_ids.dtype) for i in probed if i in self.extra_lists]
+        return np.unique(np.concatenate(lists))  # Un article déplacé peut apparaître dans deux groupes
+
+    # Fonction de recherche : top_n articles les plus similaires à la requête (profil normalisé).
+    # Avec PQ, les candidats sont pré-classés par les codes puis les rerank_factor * top_n meilleurs
+    # sont re-classés avec les embeddings exacts.
+    def search(self, query, embeddings_norm, top_n, nprobe=8, exclude=None, rerank_factor=4):
+        query = np.asarray(query, dtype=np.float32)
+        candidates = self.candidates(query, nprobe)
+        if exclude is not None and len(exclude):
+            candidates = candidates[~np.isin(candidates, exclude)]
+        if len(candidates) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if self.pq_codebooks is not None and len(candidates) > rerank_factor * top_n:
+            # Les articles ajoutés depuis la construction n'ont pas de code PQ : ils passent directement au re-classement
+            coded = candidates < len(self.pq_codes)
+            sub_dim = self.pq_codebooks.shape[2]
+            # Table des produits scalaires requête / centroïdes PQ, pour chaque sous-espace
+            tables = np.einsum("mkd,md->mk", self.pq_codebooks, query.reshape(-1, sub_dim))
+            codes = self.pq_codes[candidates[coded]]
+            approx = tables[np.arange(self.pq_subspaces), codes].sum(axis=1)
+            keep = min(len(approx), rerank_factor * top_n)
+            if keep > 0:  # Aucun candidat codé : seuls les articles ajoutés restent
+                candidates = np.concatenate([candidates[coded][np.argpartition(-approx, keep - 1)[:keep]], candidates[~coded]])
+
+        scores = embedding_rows(embeddings_norm, candidates) @ query
+        k = min(top_n, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return candidates[top].astype(np.int64), scores[top]
+
+
+# Fonction pour mesurer le rappel@k de l'index par rapport à la recherche exacte
+def evaluate_recall(index, embeddings_norm, k=5, nprobe=8, n_queries=200, seed=0):
+    rng = np.random.default_rng(seed)
+    queries = embeddings_norm[rng.choice(len(embeddings_norm), min(n_queries, len(embeddings_norm)), replace=False)]
+    found = 0
+    for query in queries:
+        exact_scores = embeddings_norm @ query
+        exact = np.argpartition(-exact_scores, k - 1)[:k]
+        approx, _ = index.search(query, embeddings_norm, k, nprobe=nprobe)
+        found += len(np.intersect1d(exact, approx))
+    return found / (k * len(queries))
+
+
+def main():
+    # Import local : function_app n'est nécessaire que pour la ligne de commande
+    from function_app import ARTIFACTS_MANIFEST, normalize_embeddings, read_artifacts_manifest
+
+    parser = argparse.ArgumentParser(description="Construction et évaluation de l'index ANN des embeddings")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build", help="Construire l'index dans la version courante des artefacts")
+    build.add_argument("artifacts", help="Dossier des artefacts colonnaires (ARTIFACTS_DIR) ou partitionnés (USER_PARTITIONS_DIR)")
+    build.add_argument("--n-lists", type=int, default=1024, help="Nombre de groupes IVF")
+    build.add_argument("--pq-subspaces", type=int, default=0, help="Nombre de sous-espaces PQ (0 : pas de PQ)")
+    build.add_argument("--n-iter", type=int, default=20, help="Nombre d'itérations du k-means")
+    recall = subparsers.add_parser("recall", help="Mesurer le rappel@k par rapport à la recherche exacte")
+    recall.add_argument("artifacts", help="Dossier des artefacts colonnaires (ARTIFACTS_DIR) ou partitionnés (USER_PARTITIONS_DIR)")
+    recall.add_argument("--k", type=int, default=5)
+    recall.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    recall.add_argument("--n-queries", type=int, default=200)
+    args = parser.parse_args()
+
+    manifest = read_artifacts_manifest(args.artifacts)
+    version_dir = os.path.join(args.artifacts, manifest["version"])
+
+    if args.command == "build":
+        embeddings_norm = normalize_embeddings(np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode="r"))
+        index = IvfIndex.build(embeddings_norm, args.n_lists, args.pq_subspaces, n_iter=args.n_iter)
+        manifest["ann"] = index.save(version_dir)
+        tmp_path = os.path.join(args.artifacts, ARTIFACTS_MANIFEST + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, os.path.join(args.artifacts, ARTIFACTS_MANIFEST))
+        print(f"Index ANN écrit dans {version_dir} : {manifest['ann']}")
+    else:
+        if not manifest.get("ann"):
+            parser.error("Aucun index ANN dans la version courante des artefacts")
+        index = IvfIndex.load(version_dir)
+        embeddings_norm = normalize_embeddings(np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode="r"))
+        for nprobe in args.nprobe:
+            value = evaluate_recall(index, embeddings_norm, k=args.k, nprobe=nprobe, n_queries=args.n_queries)
+            print(f"nprobe={nprobe:4d}  rappel@{args.k} = {value:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 
 import streamlit as st
 import requests
-import json
 import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
 # Charger les variables d'environnement depuis le fichier .env
@@ -11,30 +15,96 @@ load_dotenv()
 # Récupérer la clé API
 api_key = os.getenv('AZURE_API_KEY')
 
+# URL de base de l'API et durée de vie (secondes) des réponses gardées par l'application
+API_URL = os.getenv('API_URL', "https://recommandation-de-contenu.azurewebsites.net/api")
+CACHE_TTL = int(os.getenv('CACHE_TTL', "300"))
+USERS_PAGE_SIZE = 20
+PREFETCH_COUNT = 3  # Nombre d'utilisateurs suivants de la liste dont les recommandations sont préchargées
+MAX_STORED_RESPONSES = 1000
+
 print("Répertoire de travail actuel:", os.getcwd())
 print("Fichiers dans ce répertoire:", os.listdir())
 
-# Fonction pour obtenir les recommandations depuis l'API
-def get_recommendations(user_id,api_key):
-    # URL de l'API avec la clé de fonction Azure
-    url = f"https://recommandation-de-contenu.azurewebsites.net/api/recommend?user_id={user_id}&code={api_key}"
-
-    try:
-        response = requests.get(url)
-
-        # Vérifie si la requête a réussi (statut 200)
-        if response.status_code == 200:
-            # Parse la réponse JSON
-            data = response.json()
-            return data
-        else:
-            # Si la requête échoue
-            st.error(f"Erreur lors de la requête: {response.status_code}")
-            return None
-
-    except requests.exceptions.RequestException as e:
-        st.error(f"Erreur de connexion: {e}")
-        return None
+# Fonction pour créer, une seule fois par processus, la session HTTP (connexions gardées ouvertes d'un rerun
+# à l'autre), le pool de préchargement et les réponses gardées avec leur ETag
+@st.cache_resource
+def get_http_client():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PREFETCH_COUNT + 2)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return {
+        "session": session,
+        "executor": ThreadPoolExecutor(max_workers=PREFETCH_COUNT),
+        "responses": OrderedDict(),  # (route, paramètres) -> {"data", "etag", "fetched_at"}
+        "lock": threading.Lock(),
+    }
+
+# Fonction pour appeler une route de l'API en GET. Une réponse gardée depuis moins de CACHE_TTL (par exemple
+# préchargée) est servie sans appel ; au-delà, la requête est conditionnelle (If-None-Match) et un 304 réutilise
+# la réponse gardée sans la retransférer. Lève requests.exceptions.RequestException en cas d'erreur
+def get_json(route, **params):
+    client = get_http_client()
+    key = (route, tuple(sorted(params.items())))
+    with client["lock"]:
+        stored = client["responses"].get(key)
+    if stored and time.monotonic() - stored["fetched_at"] < CACHE_TTL:
+        return stored["data"]
+
+    headers = {"If-None-Match": stored["etag"]} if stored and stored["etag"] else {}
+    response = client["session"].get(f"{API_URL}/{route}", params={**params, "code": api_key}, headers=headers, timeout=10)
+    if response.status_code == 304 and stored:
+        data = stored["data"]
+    else:
+        response.raise_for_status()
+        data = response.json()
+
+    with client["lock"]:
+        client["responses"][key] = {"data": data, "etag": response.headers.get("ETag"), "fetched_at": time.monotonic()}
+        client["responses"].move_to_end(key)
+        while len(client["responses"]) > MAX_STORED_RESPONSES:
+            client["responses"].popitem(last=False)
+    return data
+
+# Fonction pour obtenir une page de la liste des utilisateurs (triés par identifiant) depuis l'API
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_users_page(offset, limit=USERS_PAGE_SIZE):
+    return get_json("users", offset=offset, limit=limit)
+
+# Fonction pour obtenir les recommandations depuis l'API, sans graphique (même requête que le préchargement)
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_recommendations(user_id):
+    return get_json("recommend", user_id=user_id, graph="none")
+
+# Fonction pour demander le graphique d'un utilisateur affiché (généré en arrière-plan par l'API : la réponse
+# donne son URL et son état, les recommandations sont servies depuis le cache de l'API)
+@st.cache_data(ttl=CACHE_TTL, show_spinner=False)
+def get_graph(user_id):
+    data = get_json("recommend", user_id=user_id, graph="defer")
+    return {"graph_url": data.get("graph_url"), "graph_status": data.get("graph_status")}
+
+# Fonction pour précharger en arrière-plan les recommandations des utilisateurs suivants de la liste :
+# quand ils sont choisis, la réponse est déjà gardée par get_json. Aucun graphique n'est demandé : il ne
+# l'est que pour l'utilisateur affiché
+def prefetch_recommendations(user_ids):
+    client = get_http_client()
+    for user_id in user_ids:
+        future = client["executor"].submit(get_json, "recommend", user_id=user_id, graph="none")
+        future.add_done_callback(lambda f: f.exception())  # Échec ignoré : la requête sera refaite au choix de l'utilisateur
+
+# Fonction pour attendre que le graphique (rendu en arrière-plan par l'API) soit disponible
+def wait_for_graph(user_id, timeout=15):
+    session = get_http_client()["session"]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = session.get(f"{API_URL}/recommend/graph", params={"user_id": user_id, "code": api_key}, timeout=5)
+        except requests.exceptions.RequestException:
+            return False
+        if response.status_code != 202:  # 202 : graphique en cours de génération
+            return response.status_code == 200
+        time.sleep(0.5)
+    return False
 
 # Fonction pour afficher les numéros d'articles suivis de l'icône dans des colonnes
 def display_article_icons(article_ids):
@@ -42,7 +112,7 @@ def display_article_icons(article_ids):
 
     # Créer une ligne de colonnes pour afficher les articles côte à côte
     cols = st.columns(5)  # Crée 5 colonnes
-    
+
     # Afficher les numéros d'articles suivis de l'icône dans chaque colonne
     for i, article_id in enumerate(article_ids):
         with cols[i]:
@@ -52,27 +122,63 @@ def display_article_icons(article_ids):
 # Titre de l'application
 st.title("Recommandation de Contenu")
 
-# Initialiser la session d'état pour garder l'ID de l'utilisateur
+# Initialiser la session d'état pour garder la page de la liste et l'ID de l'utilisateur
+if 'users_offset' not in st.session_state:
+    st.session_state.users_offset = 0
 if 'user_id' not in st.session_state:
     st.session_state.user_id = None
 
-# Demander l'ID de l'utilisateur
-if st.session_state.user_id is None:
-    user_id = st.number_input("Entrez votre identifiant utilisateur", min_value=1, step=1, value=None)  # Pas de valeur par défaut
-else:
-    user_id = st.session_state.user_id
-
-# Si l'utilisateur saisit un ID, le stocker dans le session_state
-if user_id and user_id != st.session_state.user_id:
-    st.session_state.user_id = user_id
-    st.session_state.recommendations_displayed = False  # État pour ne pas afficher les anciennes recommandations
-
-# Si les recommandations ne sont pas encore affichées et que l'ID utilisateur est défini
-if st.session_state.user_id and not st.session_state.get('recommendations_displayed', False):
-    # Obtenir les recommandations
-    data = get_recommendations(st.session_state.user_id,api_key=api_key)
+# Liste paginée des utilisateurs dans la barre latérale
+page = None
+with st.sidebar:
+    st.header("Utilisateurs")
+    try:
+        page = get_users_page(st.session_state.users_offset)
+    except requests.exceptions.RequestException as e:
+        st.error(f"Erreur lors de la récupération des utilisateurs : {e}")
+
+    if page and page['users']:
+        user_ids = [user['user_id'] for user in page['users']]
+        history_counts = {user['user_id']: user['history_count'] for user in page['users']}
+        # Le choix n'est pris en compte que lorsqu'il change (sinon il écraserait un identifiant saisi)
+        st.radio(
+            f"Utilisateurs {page['offset'] + 1} à {page['offset'] + len(user_ids)} sur {page['total']}",
+            user_ids,
+            index=user_ids.index(st.session_state.user_id) if st.session_state.user_id in user_ids else None,
+            format_func=lambda user_id: f"{user_id} ({history_counts[user_id]} articles lus)",
+            key="selected_user",
+            on_change=lambda: st.session_state.update(user_id=st.session_state.selected_user),
+        )
+
+        previous_col, next_col = st.columns(2)
+        if previous_col.button("Précédent", disabled=page['offset'] == 0):
+            st.session_state.users_offset = max(page['offset'] - USERS_PAGE_SIZE, 0)
+            st.rerun()
+        if next_col.button("Suivant", disabled=page['next_offset'] is None):
+            st.session_state.users_offset = page['next_offset']
+            st.rerun()
+
+    # Saisie directe d'un identifiant absent de la page affichée
+    typed_user_id = st.number_input("Ou entrez un identifiant utilisateur", min_value=0, step=1, value=None)
+    if typed_user_id is not None and st.button("Afficher"):
+        st.session_state.user_id = int(typed_user_id)
+
+# Afficher les recommandations de l'utilisateur choisi
+if st.session_state.user_id is not None:
+    data = None
+    try:
+        data = get_recommendations(st.session_state.user_id)
+    except requests.exceptions.HTTPError as e:
+        st.error(f"Erreur lors de la requête: {e.response.status_code}")
+    except requests.exceptions.RequestException as e:
+        st.error(f"Erreur de connexion: {e}")
 
     if data:
+        # Précharger les recommandations des utilisateurs suivants pendant l'affichage de celles-ci
+        if page and page['users'] and st.session_state.user_id in user_ids:
+            position = user_ids.index(st.session_state.user_id)
+            prefetch_recommendations(user_ids[position + 1:position + 1 + PREFETCH_COUNT])
+
         # Afficher l'identifiant de l'utilisateur
         st.write(f"Votre identifiant est : {data['user_id']}")
         # Afficher le dernier article lu de l'utilisateur
@@ -86,23 +192,20 @@ if st.session_state.user_id and not st.session_state.get('recommendations_displa
         st.subheader("Articles similaires recommandés :")
         # Afficher les icônes des articles recommandés côte à côte
         display_article_icons(data['recommendations'])
-        # Marquer les recommandations comme affichées
-        st.session_state.recommendations_displayed = True
 
         st.subheader("Visualisation des recommandations")
-        graph_url = data.get('graph_url')  # Récupérer l'URL de l'image depuis la réponse
+        graph = {}
+        try:
+            graph = get_graph(st.session_state.user_id)
+        except requests.exceptions.RequestException as e:
+            st.warning(f"Graphique indisponible : {e}")
+        graph_url = graph.get('graph_url')  # Récupérer l'URL de l'image
 
         if graph_url:
-            # Afficher l'image depuis l'URL dans Streamlit
-            st.image(graph_url, caption="Graphique des embeddings et recommandations", use_container_width=True)
-
-
-        # Marquer les recommandations comme affichées
-        st.session_state.recommendations_displayed = True
-
-# Ajouter un bouton pour recommencer avec un nouvel identifiant
-if st.button('Recommencer avec un nouvel identifiant'):
-    # Réinitialiser l'ID utilisateur dans session_state
-    st.session_state.user_id = None
-    st.session_state.recommendations_displayed = False  # Réinitialiser l'état des recommandations
-    st.rerun()  # Recharger l'application pour recommencer
+            with st.spinner("Génération du graphique..."):
+                graph_ready = graph.get('graph_status') == 'ready' or wait_for_graph(st.session_state.user_id)
+            if graph_ready:
+                # Afficher l'image depuis l'URL dans Streamlit
+                st.image(graph_url, caption="Graphique des embeddings et recommandations", use_container_width=True)
+            else:
+                st.warning("Le graphique n'est pas encore disponible.")
@@ -0,0 +1,292 @@
+"""
+Benchmark de latence / débit de la route /api/recommend, sans compte de stockage Azure
+
+Le benchmark génère des clics, des recommandations et des embeddings synthétiques à l'échelle demandée,
+les sert avec le stockage local de storage.py (STORAGE_BACKEND=local), puis appelle directement le handler
+main() de function_app.py dans plusieurs modes :
+    cold        : cache de données vidé avant chaque requête (téléchargement + parsing à chaque fois)
+    warm        : données en cache, utilisateurs tirés au hasard
+    single      : données en cache, toujours le même utilisateur
+    concurrent  : données en cache, plusieurs requêtes simultanées sur la boucle d'événements (main() est asynchrone)
+Pour chaque mode : latences p50 / p95 / p99, débit, pic de mémoire résidente et temps passé par étape
+(histogrammes de function_app.get_metrics() : download, parse, index, lookup, scoring, render, upload). Les résultats sont enregistrés en JSON
+pour comparer deux versions du code.
+
+Utilisation :
+    python benchmarks/bench_recommend.py --scale 100k
+    python benchmarks/bench_recommend.py --scale 1m --modes warm concurrent --concurrency 32 --graph none
+    python benchmarks/bench_recommend.py --scale 100k --compare benchmarks/results/100k-20250101-120000.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+MODES = ("cold", "warm", "single", "concurrent")
+
+# Fonction pour générer un jeu de données synthétique (mis en cache dans benchmarks/.data)
+def generate_dataset(n_clicks, n_articles, dim, reco_ratio, seed):
+    directory = os.path.join(BENCH_DIR, ".data", f"{n_clicks}-{n_articles}-{dim}-{reco_ratio}-{seed}")
+    paths = {name: os.path.join(directory, file_name) for name, file_name in
+             (("clicks", "clicks_sample.csv"), ("recommendations", "recommandations.json"), ("embeddings", "embeddings.npy"))}
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+
+    print(f"Génération du jeu de données synthétique dans {directory}")
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_users = max(1, n_clicks // 8)
+    # Popularité des articles en loi de puissance, comme dans les vraies données de clics
+    popularity = rng.pareto(1.2, n_articles) + 1
+    popularity /= popularity.sum()
+    clicks = pd.DataFrame({
+        "user_id": rng.integers(0, n_users, n_clicks),
+        "session_id": rng.integers(0, 10 ** 9, n_clicks),
+        "session_start": rng.integers(1_506_000_000_000, 1_508_000_000_000, n_clicks),
+        "session_size": rng.integers(2, 10, n_clicks),
+        "click_article_id": rng.choice(n_articles, n_clicks, p=popularity),
+        "click_timestamp": rng.integers(1_506_000_000_000, 1_508_000_000_000, n_clicks),
+        "click_environment": rng.integers(1, 5, n_clicks),
+        "click_deviceGroup": rng.integers(1, 5, n_clicks),
+        "click_os": rng.integers(1, 20, n_clicks),
+        "click_country": rng.integers(1, 12, n_clicks),
+        "click_region": rng.integers(1, 28, n_clicks),
+        "click_referrer_type": rng.integers(1, 7, n_clicks),
+    })
+    clicks.to_csv(paths["clicks"], index=False)
+
+    reco_users = np.unique(clicks["user_id"].to_numpy())
+    reco_users = reco_users[rng.random(len(reco_users)) < reco_ratio]
+    recommendations = pd.DataFrame({
+        "user_id": np.repeat(reco_users, 5),
+        "article_id": rng.integers(0, n_articles, 5 * len(reco_users)),
+        "similarity_score": np.round(rng.random(5 * len(reco_users)), 6),
+    })
+    recommendations.to_json(paths["recommendations"])
+    np.save(paths["embeddings"], rng.normal(size=(n_articles, dim)))
+    return paths
+
+
+# Fonction pour importer function_app.py branché sur le stockage local
+def setup_function_app(paths, work_dir, artifacts_dir, partitions_dir=None):
+    os.environ.update({
+        "CLICK_SAMPLE_PATH": paths["clicks"],
+        "RECOMMANDATIONS_PATH": paths["recommendations"],
+        "EMBEDDINGS_PATH": paths["embeddings"],
+        "STORAGE_BACKEND": "local",
+        "LOCAL_STORAGE_ROOT": work_dir,
+    })
+    if artifacts_dir:
+        os.environ["ARTIFACTS_DIR"] = artifacts_dir
+    if partitions_dir:
+        os.environ["USER_PARTITIONS_DIR"] = partitions_dir
+    import function_app
+    return function_app
+
+
+# Fonction pour vider les caches du processus (démarrage à froid simulé)
+def reset_caches(fa):
+    with fa._data_cache_lock:
+        fa._data_cache.update(data=None, etags={}, version=None, checked_at=0.0, revalidating=False)
+    with fa._graph_cache_lock:
+        fa._graph_cache.clear()
+    with fa._graph_background_lock:
+        fa._graph_background.update(embeddings=None, image=None, extent=None)
+    with fa._partition_cache_lock:
+        fa._partition_cache.clear()
+    with fa._response_cache_lock:
+        fa._response_cache.clear()
+        fa._response_cache_state.update(version=None, bytes=0)
+
+
+# Fonction pour appeler le handler pour un utilisateur. Retourne (code HTTP, durée en secondes)
+async def call(fa, user_id, graph):
+    import azure.functions as func
+
+    request = func.HttpRequest(method="GET", url="/api/recommend", params={"user_id": str(user_id), "graph": graph}, body=b"")
+    start = time.perf_counter()
+    response = await fa.main(request)
+    return response.status_code, time.perf_counter() - start
+
+
+# Fonction pour envoyer des requêtes avec au plus `concurrency` requêtes simultanées. Retourne [(code HTTP, durée)]
+async def call_many(fa, user_ids, graph, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded_call(user_id):
+        async with semaphore:
+            return await call(fa, int(user_id), graph)
+    return await asyncio.gather(*(bounded_call(user_id) for user_id in user_ids))
+
+
+# Fonction pour attendre la fin des graphiques différés (graph=defer) avant le mode suivant. Retourne la durée d'attente
+def drain_graphs(fa):
+    start = time.perf_counter()
+    while fa._graph_pending["count"] > 0:
+        time.sleep(0.01)
+    return time.perf_counter() - start
+
+
+# Fonction pour exécuter un mode et mesurer latences, débit, mémoire et étapes
+def run_mode(fa, mode, user_ids, args, rng):
+    if mode != "cold":
+        fa.get_data()  # Préchauffage hors mesure
+    with fa._metrics_lock:
+        fa._metrics["stages"].clear()
+
+    results = []
+    started = time.perf_counter()
+    if mode == "cold":
+        for _ in range(args.cold_repeats):
+            reset_caches(fa)
+            results.append(asyncio.run(call(fa, int(rng.choice(user_ids)), args.graph)))
+            drain_graphs(fa)
+    else:
+        if mode == "single":
+            chosen = np.full(args.requests, user_ids[0])
+        else:
+            chosen = rng.choice(user_ids, args.requests)
+        concurrency = args.concurrency if mode == "concurrent" else 1
+        results = asyncio.run(call_many(fa, chosen, args.graph, concurrency))
+    wall = time.perf_counter() - started
+    graph_drain = drain_graphs(fa)
+    statuses = [status for status, _ in results]
+    latencies = [latency for _, latency in results]
+
+    latencies_ms = np.array(latencies) * 1000
+    stages = {stage: {"total_s": round(metric["sum_ms"] / 1000, 4), "calls": metric["count"], "mean_ms": metric["mean_ms"],
+                      "p95_ms": metric["p95_ms"]}
+              for stage, metric in fa.get_metrics()["stages"].items()}
+    return {
+        "requests": len(latencies),
+        "errors": sum(status >= 500 for status in statuses),
+        "statuses": {str(code): statuses.count(code) for code in sorted(set(statuses))},
+        "latency_ms": {
+            "mean": round(float(latencies_ms.mean()), 3),
+            "p50": round(float(np.percentile(latencies_ms, 50)), 3),
+            "p95": round(float(np.percentile(latencies_ms, 95)), 3),
+            "p99": round(float(np.percentile(latencies_ms, 99)), 3),
+            "max": round(float(latencies_ms.max()), 3),
+        },
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "graph_drain_s": round(graph_drain, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "stages": stages,
+    }
+
+
+# Fonction pour décrire l'environnement (pour comparer des résultats entre versions)
+def environment():
+    try:
+        commit = subprocess.run(["git", "-C", ROOT_DIR, "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"git_commit": commit, "python": platform.python_version(), "numpy": np.__version__,
+            "pandas": pd.__version__, "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+# Fonction pour afficher les écarts par rapport à un résultat précédent
+def compare(results, previous_path):
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    print(f"\nComparaison avec {previous_path} (commit {previous['environment'].get('git_commit')}) :")
+    for mode, stats in results["modes"].items():
+        before = previous["modes"].get(mode)
+        if before is None:
+            continue
+        for metric in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][metric], stats["latency_ms"][metric]
+            print(f"  {mode:10s} {metric}: {old:10.2f} ms -> {new:10.2f} ms ({(new - old) / old * 100:+.1f} %)")
+        old, new = before["throughput_rps"], stats["throughput_rps"]
+        print(f"  {mode:10s} débit: {old:10.2f} req/s -> {new:10.2f} req/s ({(new - old) / old * 100:+.1f} %)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la route /api/recommend avec un stockage local")
+    parser.add_argument("--scale", choices=SCALES, default="100k", help="Nombre de clics générés")
+    parser.add_argument("--articles", type=int, default=50_000, help="Nombre d'articles")
+    parser.add_argument("--dim", type=int, default=2, help="Dimension des embeddings")
+    parser.add_argument("--reco-ratio", type=float, default=0.8, help="Part des utilisateurs avec des recommandations pré-calculées")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--requests", type=int, default=200, help="Requêtes par mode (hors cold)")
+    parser.add_argument("--cold-repeats", type=int, default=3, help="Requêtes à froid")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requêtes simultanées du mode concurrent")
+    parser.add_argument("--graph", choices=("sync", "defer", "none"), default="defer", help="Génération du graphique")
+    parser.add_argument("--columnar", action="store_true", help="Servir les artefacts colonnaires (ARTIFACTS_DIR)")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="Servir des partitions d'utilisateurs (USER_PARTITIONS_DIR) : nombre de partitions")
+    parser.add_argument("--no-response-cache", action="store_true",
+                        help="Désactiver le cache des réponses (RESPONSE_CACHE_TTL=0) : chaque requête est calculée")
+    parser.add_argument("--memory-mode", choices=("full", "compact"), default="full", help="MEMORY_MODE de la fonction")
+    parser.add_argument("--embeddings-precision", choices=("float32", "float16", "int8", "auto"),
+                        help="EMBEDDINGS_PRECISION de la fonction (défaut : celui de --memory-mode)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Fichier JSON de résultats (défaut : benchmarks/results/<scale>-<date>.json)")
+    parser.add_argument("--compare", help="Fichier JSON d'un résultat précédent à comparer")
+    args = parser.parse_args()
+
+    paths = generate_dataset(SCALES[args.scale], args.articles, args.dim, args.reco_ratio, args.seed)
+    work_dir = os.path.join(BENCH_DIR, ".data", "storage")
+    artifacts_dir = None
+    if args.columnar:
+        artifacts_dir = os.path.join(os.path.dirname(paths["clicks"]), "artifacts")
+    partitions_dir = None
+    if args.partitions > 0:
+        partitions_dir = os.path.join(os.path.dirname(paths["clicks"]), f"partitions-{args.partitions}")
+    os.environ["MEMORY_MODE"] = args.memory_mode
+    if args.embeddings_precision:
+        os.environ["EMBEDDINGS_PRECISION"] = args.embeddings_precision
+    if args.no_response_cache:
+        os.environ["RESPONSE_CACHE_TTL"] = "0"
+    fa = setup_function_app(paths, work_dir, artifacts_dir, partitions_dir)
+    if artifacts_dir and not fa.use_columnar_artifacts():
+        df_clicks_sample, df_recommandations, embeddings_2D = fa.load_data()
+        fa.write_columnar_artifacts(artifacts_dir, df_clicks_sample, df_recommandations, embeddings_2D)
+    if partitions_dir and not fa.use_user_partitions():
+        df_clicks_sample, df_recommandations, embeddings_2D = fa.load_data()
+        os.makedirs(partitions_dir, exist_ok=True)
+        fa.write_user_partitions(partitions_dir, df_clicks_sample, df_recommandations, embeddings_2D, args.partitions)
+
+    user_ids = pd.read_csv(paths["clicks"], usecols=["user_id"])["user_id"].unique()
+    rng = np.random.default_rng(args.seed)
+    results = {
+        "environment": environment(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "modes": {},
+    }
+    for mode in args.modes:
+        print(f"Mode {mode}...")
+        stats = run_mode(fa, mode, user_ids, args, rng)
+        results["modes"][mode] = stats
+        latency = stats["latency_ms"]
+        print(f"  p50 {latency['p50']:.2f} ms  p95 {latency['p95']:.2f} ms  p99 {latency['p99']:.2f} ms  "
+              f"débit {stats['throughput_rps']:.1f} req/s  RSS max {stats['peak_rss_mb']:.0f} Mo  erreurs {stats['errors']}")
+        for stage, timing in stats["stages"].items():
+            print(f"    {stage:22s} {timing['mean_ms']:10.3f} ms x {timing['calls']}")
+
+    output = args.output or os.path.join(BENCH_DIR, "results", f"{args.scale}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Résultats enregistrés dans {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Conversion des artefacts CSV / JSON / npy vers le format binaire colonnaire lu par function_app.py
+
+Utilisation :
+    python convert_artifacts.py clicks_sample.csv recommandations.json embeddings.npy artifacts/
+
+Puis définir la variable d'environnement ARTIFACTS_DIR=artifacts/ (ou le point de montage du
+partage de fichiers) pour que la fonction charge ces fichiers en mémoire mappée au lieu de
+télécharger et parser les fichiers d'origine. L'index ANN optionnel se construit ensuite avec
+    python ann_index.py build artifacts/
+
+Pour les jeux de données plus grands que la mémoire d'un worker, --partitions N répartit les utilisateurs
+par hachage de user_id en N partitions chargées à la demande (définir USER_PARTITIONS_DIR=partitions/) :
+    python convert_artifacts.py clicks_sample.csv recommandations.json embeddings.npy partitions/ --partitions 64
+L'index ANN des partitions se construit de la même façon (python ann_index.py build partitions/).
+"""
+
+import argparse
+import logging
+import os
+
+from function_app import (ARTIFACTS_MANIFEST, EMBEDDINGS_PRECISIONS, parse_clicks, parse_embeddings,
+                          parse_recommendations, prune_artifact_versions, read_artifacts_manifest, write_columnar_artifacts,
+                          write_user_partitions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Conversion des artefacts au format colonnaire memory-mapped")
+    parser.add_argument("clicks", help="Fichier CSV des clics (clicks_sample)")
+    parser.add_argument("recommendations", help="Fichier JSON des recommandations pré-calculées")
+    parser.add_argument("embeddings", help="Fichier .npy des embeddings")
+    parser.add_argument("output", help="Dossier de sortie (ARTIFACTS_DIR, ou USER_PARTITIONS_DIR avec --partitions)")
+    parser.add_argument("--keep", type=int, default=2, help="Nombre de versions à conserver dans le dossier de sortie")
+    parser.add_argument("--partitions", type=int, default=0, help="Nombre de partitions d'utilisateurs (0 : pas de partitionnement)")
+    parser.add_argument("--embeddings-precision", choices=EMBEDDINGS_PRECISIONS,
+                        help="Type des embeddings normalisés écrits (défaut : EMBEDDINGS_PRECISION, float32 si auto)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    os.makedirs(args.output, exist_ok=True)
+
+    with open(args.clicks, "rb") as f:
+        df_clicks_sample = parse_clicks(f.read())
+    with open(args.recommendations, "rb") as f:
+        df_recommandations = parse_recommendations(f.read())
+    with open(args.embeddings, "rb") as f:
+        embeddings_2D = parse_embeddings(f.read())
+
+    previous = read_artifacts_manifest(args.output) if os.path.exists(os.path.join(args.output, ARTIFACTS_MANIFEST)) else None
+    if args.partitions > 0:
+        manifest = write_user_partitions(args.output, df_clicks_sample, df_recommandations, embeddings_2D, args.partitions,
+                                         embeddings_precision=args.embeddings_precision)
+    else:
+        manifest = write_columnar_artifacts(args.output, df_clicks_sample, df_recommandations, embeddings_2D,
+                                            embeddings_precision=args.embeddings_precision)
+    prune_artifact_versions(args.output, args.keep)
+
+    if previous and previous["version"] == manifest["version"]:
+        print(f"Artefacts inchangés (version {manifest['version']})")
+    else:
+        print(f"Artefacts version {manifest['version']} écrits dans {args.output} : "
+              f"{manifest['n_clicks']} clics, {manifest['n_users']} utilisateurs, "
+              f"{manifest['n_recommendations']} recommandations, embeddings {manifest['embeddings_shape']}"
+              + (f", {manifest['n_partitions']} partitions" if args.partitions > 0 else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -21,13 +21,32 @@ import logging
 import json
 import os
 import io
+import time
+import asyncio
+import bisect
+import shutil
+import hashlib
+import mmap
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+try:
+    import fcntl  # Verrou de fichier entre workers (Linux, hôte Azure Functions)
+except ImportError:
+    fcntl = None
 import pandas as pd
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')  # Force Matplotlib à utiliser un backend sans interface graphique
-import matplotlib.pyplot as plt
-from azure.storage.blob import BlobServiceClient, BlobClient, ContainerClient
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import azure.functions as func
+from ann_index import IvfIndex, embedding_dot, embedding_rows, quantize_embeddings
+from storage import storage_from_env
 
 # 2. Définition de l'app et décorateur
 app = func.FunctionApp()
@@ -38,6 +57,22 @@ RECOMMANDATIONS_PATH = os.getenv('RECOMMANDATIONS_PATH')
 EMBEDDINGS_PATH = os.getenv('EMBEDDINGS_PATH')
 GRAPHS_SAS_URL = os.getenv("GRAPHS_SAS_URL")
 CONTAINER_NAME = "graphs"
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "10000"))
+MAX_TOP_N = 100  # Nombre maximal de recommandations par utilisateur demandé à /recommend/batch
+EXACT_RERANK_FACTOR = 4  # Candidats re-classés en float32 par recommandation quand les embeddings sont quantifiés
+GRAPH_CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", "1024"))  # Nombre de graphiques à jour mémorisés (clés seulement)
+GRAPH_WORKERS = int(os.getenv("GRAPH_WORKERS", "2"))  # Threads de rendu pour les graphiques différés (graph=defer)
+GRAPH_MAX_PENDING = int(os.getenv("GRAPH_MAX_PENDING", "256"))  # Graphiques différés en attente au maximum (au-delà : pas de graphique)
+GRAPH_MODES = ("sync", "defer", "none")
+# Représentation des données en mémoire (voir la section 4) :
+#   MEMORY_MODE=full (défaut) : DataFrames complets, types par défaut ; compact : colonnes utiles seulement, types réduits
+#   EMBEDDINGS_PRECISION : type des embeddings normalisés servant au calcul des scores (float32, float16, int8 ou
+#   auto, par défaut en mode compact). Hors float32, les meilleurs candidats sont re-classés avec des scores exacts
+#   MEMORY_BUDGET_MB : budget utilisé par EMBEDDINGS_PRECISION=auto
+MEMORY_MODE = os.getenv("MEMORY_MODE", "full")
+EMBEDDINGS_PRECISION = os.getenv("EMBEDDINGS_PRECISION", "auto" if MEMORY_MODE == "compact" else "float32")
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "0"))
+EMBEDDINGS_PRECISIONS = ("float32", "float16", "int8")  # Du plus précis au plus compact
 
 logging.info(f"CLICK_SAMPLE_PATH: {CLICK_SAMPLE_PATH}")
 logging.info(f"RECOMMANDATIONS_PATH: {RECOMMANDATIONS_PATH}")
@@ -45,121 +80,1395 @@ logging.info(f"EMBEDDINGS_PATH: {EMBEDDINGS_PATH}")
 logging.info(f"GRAPHS_SAS_URL: {GRAPHS_SAS_URL}")
 
 
+# 3 bis. Instrumentation : temps par étape et journalisation de diagnostic
+# Chaque étape (download, parse, load, lookup, scoring, render, upload) est chronométrée avec timed_stage().
+# Les durées alimentent des histogrammes par processus (route /metrics) et, pendant une requête, l'en-tête
+# Server-Timing de la réponse. Les diagnostics volumineux (DataFrames, historiques complets) ne sont formatés
+# que si le niveau DEBUG est actif : sinon ils ne coûtent qu'un test de niveau.
+
+# Bornes supérieures (ms) des classes des histogrammes
+METRICS_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_metrics = {"stages": {}, "routes": {}}
+_metrics_lock = threading.Lock()
+# Durées de la requête en cours (None hors requête, par exemple dans le thread de revalidation)
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+# Fonction pour savoir si les diagnostics détaillés doivent être journalisés
+def debug_enabled():
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+# Fonction pour ajouter une durée à l'histogramme d'une étape ou d'une route
+def observe_duration(kind, name, duration_ms):
+    with _metrics_lock:
+        metric = _metrics[kind].get(name)
+        if metric is None:
+            metric = _metrics[kind][name] = {"count": 0, "sum_ms": 0.0, "max_ms": 0.0, "buckets": [0] * (len(METRICS_BUCKETS_MS) + 1)}
+        metric["count"] += 1
+        metric["sum_ms"] += duration_ms
+        metric["max_ms"] = max(metric["max_ms"], duration_ms)
+        metric["buckets"][bisect.bisect_left(METRICS_BUCKETS_MS, duration_ms)] += 1
+
+# Fonction pour chronométrer une étape (histogramme + Server-Timing de la requête en cours)
+@contextlib.contextmanager
+def timed_stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + duration_ms
+        observe_duration("stages", name, duration_ms)
+
+# Fonction pour formater les durées d'une requête en en-tête Server-Timing
+def format_server_timing(timings):
+    return ", ".join(f"{name};dur={duration_ms:.2f}" for name, duration_ms in timings.items())
+
+# Décorateur des routes HTTP (synchrones ou asynchrones) : chronomètre la requête et ajoute l'en-tête
+# Server-Timing à la réponse
+def with_server_timing(route_name):
+    def decorator(handler):
+        def finish(token, timings, start, response=None):
+            _request_timings.reset(token)
+            timings["total"] = (time.perf_counter() - start) * 1000
+            observe_duration("routes", route_name, timings["total"])
+            if response is not None:
+                response.headers["Server-Timing"] = format_server_timing(timings)
+            return response
+
+        if inspect.iscoroutinefunction(handler):
+            @functools.wraps(handler)
+            async def wrapper(req):
+                timings, start = {}, time.perf_counter()
+                token = _request_timings.set(timings)
+                try:
+                    response = await handler(req)
+                except BaseException:
+                    finish(token, timings, start)
+                    raise
+                return finish(token, timings, start, response)
+        else:
+            @functools.wraps(handler)
+            def wrapper(req):
+                timings, start = {}, time.perf_counter()
+                token = _request_timings.set(timings)
+                try:
+                    response = handler(req)
+                except BaseException:
+                    finish(token, timings, start)
+                    raise
+                return finish(token, timings, start, response)
+        return wrapper
+    return decorator
+
+# Fonction pour estimer un quantile à partir d'un histogramme (borne supérieure de la classe)
+def histogram_quantile(metric, q):
+    rank, seen = q * metric["count"], 0
+    for bound, count in zip(METRICS_BUCKETS_MS + (metric["max_ms"],), metric["buckets"]):
+        seen += count
+        if seen >= rank:
+            return min(bound, metric["max_ms"])
+    return metric["max_ms"]
+
+# Fonction pour exposer les histogrammes (classes cumulées, comme un histogramme Prometheus)
+def get_metrics():
+    with _metrics_lock:
+        snapshot = {kind: {name: dict(metric, buckets=list(metric["buckets"])) for name, metric in metrics.items()}
+                    for kind, metrics in _metrics.items()}
+    result = {"buckets_ms": list(METRICS_BUCKETS_MS)}
+    for kind, metrics in snapshot.items():
+        result[kind] = {}
+        for name, metric in sorted(metrics.items()):
+            cumulative = np.cumsum(metric["buckets"]).tolist()
+            result[kind][name] = {
+                "count": metric["count"],
+                "sum_ms": round(metric["sum_ms"], 3),
+                "mean_ms": round(metric["sum_ms"] / metric["count"], 3),
+                "max_ms": round(metric["max_ms"], 3),
+                "p50_ms": round(histogram_quantile(metric, 0.50), 3),
+                "p95_ms": round(histogram_quantile(metric, 0.95), 3),
+                "p99_ms": round(histogram_quantile(metric, 0.99), 3),
+                "buckets": {**{f"le_{bound}": n for bound, n in zip(METRICS_BUCKETS_MS, cumulative)}, "le_inf": cumulative[-1]},
+            }
+    return result
+
+
 # 4. Fonctions auxiliaires pour récupérer un fichier depuis Azure Blob Storage et charger les données
+# Le stockage (Azure Blob Storage ou dossier local, voir storage.py) est créé une seule fois par processus :
+# ses clients et leurs connexions HTTP sont réutilisés par toutes les requêtes.
+_storage = None
+_storage_lock = threading.Lock()
+
+# Fonction pour récupérer le stockage du processus (créé au premier appel)
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = storage_from_env()
+        return _storage
+
+# Fonction pour télécharger un fichier et récupérer son ETag dans le même appel
+def download_blob_with_etag(url):
+    return get_storage().read(url)
+
+# Fonction pour lire uniquement l'ETag d'un blob (requête HEAD, sans téléchargement)
+def get_blob_etag(url):
+    return get_storage().get_etag(url)
+
+# Fonction pour réduire des colonnes d'identifiants au plus petit type entier du format colonnaire
+def downcast_ids(df, columns):
+    return df.astype({column: smallest_int_dtype(df[column].to_numpy()) for column in columns})
 
-# Fonction pour télécharger un fichier depuis Blob Storage dans la mémoire en utilisant une URL SAS
-def download_blob_to_memory(url):
-    blob_client = BlobClient.from_blob_url(url)
-    download_stream = blob_client.download_blob()
-    return download_stream.readall()
+# Fonction pour obtenir le résumé DataFrame.info() sous forme de texte (info() écrit sur la sortie standard par défaut)
+def dataframe_info(df):
+    buffer = io.StringIO()
+    df.info(buf=buffer)
+    return buffer.getvalue()
+
+# Fonctions pour convertir le contenu brut de chaque fichier
+# En mode compact, seules les colonnes utilisées pour servir les recommandations sont gardées, les identifiants
+# sont réduits au plus petit type entier du format colonnaire (int32 ou int64) et les flottants passent en float32
+def parse_clicks(df_clicks_sample_data):
+    if MEMORY_MODE == "compact":
+        df_clicks_sample = pd.read_csv(io.BytesIO(df_clicks_sample_data), sep=',', usecols=['user_id', 'click_article_id'])
+        df_clicks_sample = downcast_ids(df_clicks_sample, ['user_id', 'click_article_id'])
+    else:
+        df_clicks_sample = pd.read_csv(io.BytesIO(df_clicks_sample_data), sep=',', low_memory=False)
+    logging.info(f"df_clicks_sample chargé avec succès, shape: {df_clicks_sample.shape}")
+    if debug_enabled():
+        logging.debug(f"df_clicks_sample info:\n{dataframe_info(df_clicks_sample)}")
+        logging.debug(f"Exemples d'user_id : {df_clicks_sample['user_id'].unique()[:10]}")
+
+        # Vérifier si l'user_id 42 existe dans df_clicks_sample et afficher les lignes correspondantes
+        logging.debug(f"Existe-t-il un user_id 42 dans df_clicks_sample ? {42 in df_clicks_sample['user_id'].values}")
+        logging.debug(f"Lignes correspondant à user_id 42 dans df_clicks_sample:\n{df_clicks_sample[df_clicks_sample['user_id'] == 42]}")
+    return df_clicks_sample
+
+def parse_recommendations(df_recommandations_data):
+    df_recommandations = pd.read_json(io.BytesIO(df_recommandations_data))
+    if MEMORY_MODE == "compact":
+        df_recommandations = downcast_ids(df_recommandations[['user_id', 'article_id', 'similarity_score']], ['user_id', 'article_id'])
+        df_recommandations['similarity_score'] = df_recommandations['similarity_score'].astype(np.float32)
+    logging.info(f"df_recommandations chargé avec succès, shape: {df_recommandations.shape}")
+    if debug_enabled():
+        logging.debug(f"df_recommandations info:\n{dataframe_info(df_recommandations)}")
+        logging.debug(f"Exemples d'user_id : {df_recommandations['user_id'].unique()[:10]}")
+    return df_recommandations
+
+def parse_embeddings(embeddings_data):
+    if MEMORY_MODE == "compact":
+        try:
+            embeddings_2D = np.load(io.BytesIO(embeddings_data), allow_pickle=False)
+        except ValueError:
+            logging.warning("Le fichier d'embeddings contient des objets Python : chargement avec pickle avant conversion.")
+            embeddings_2D = np.load(io.BytesIO(embeddings_data), allow_pickle=True)
+        embeddings_2D = np.asarray(embeddings_2D, dtype=np.float32)
+    else:
+        embeddings_2D = np.load(io.BytesIO(embeddings_data), allow_pickle=True)
+    logging.info(f"Embeddings chargés. Type : {type(embeddings_2D)}, Dimensions : {embeddings_2D.shape if hasattr(embeddings_2D, 'shape') else 'N/A'}")
+    return embeddings_2D
+
+# Artefacts chargés par load_data() : nom -> (URL SAS du blob, fonction de parsing)
+ARTIFACTS = {
+    "clicks": (CLICK_SAMPLE_PATH, parse_clicks),
+    "recommendations": (RECOMMANDATIONS_PATH, parse_recommendations),
+    "embeddings": (EMBEDDINGS_PATH, parse_embeddings),
+}
+
+# Fonction pour télécharger et charger une partie des artefacts. Retourne {nom: (objet chargé, etag)}
+# Les fichiers sont téléchargés en parallèle, puis convertis dans l'ordre.
+def load_artifacts(names):
+    names = list(names)
+    with timed_stage("download"):
+        with ThreadPoolExecutor(max_workers=max(1, len(names)), thread_name_prefix="download") as pool:
+            downloads = dict(zip(names, pool.map(lambda name: download_blob_with_etag(ARTIFACTS[name][0]), names)))
+
+    loaded = {}
+    for name in names:
+        raw_data, etag = downloads[name]
+        logging.info(f"{name} téléchargé avec succès ({len(raw_data)} octets, ETag {etag})")
+        if not raw_data:
+            raise ValueError(f"Le fichier {name} n'a pas été téléchargé correctement")
+        with timed_stage("parse"):
+            loaded[name] = (ARTIFACTS[name][1](raw_data), etag)
+    return loaded
 
 # Fonction pour charger les données en DataFrame
 def load_data():
     logging.info("Début du téléchargement des fichiers depuis Blob Storage")
-    
     try:
-        # Télécharger les fichiers directement depuis Blob Storage dans la mémoire
-        df_clicks_sample_data = download_blob_to_memory(CLICK_SAMPLE_PATH)
-        logging.info("df_clicks_sample téléchargé avec succès")
-        logging.info(f"Taille de df_clicks_sample_data : {len(df_clicks_sample_data)} octets")
-        logging.info(f"Premiers octets de df_clicks_sample_data : {df_clicks_sample_data[:100]}")
-
-        df_recommandations_data = download_blob_to_memory(RECOMMANDATIONS_PATH)
-        logging.info("df_recommandations téléchargé avec succès")
-        logging.info(f"Taille de df_recommandations_data : {len(df_recommandations_data)} octets")
-        logging.info(f"Premiers octets de df_recommandations_data : {df_recommandations_data[:100]}")
-
-        embeddings_data = download_blob_to_memory(EMBEDDINGS_PATH)
-        logging.info("embeddings_data téléchargé avec succès")
-        logging.info(f"Taille des embeddings téléchargés : {len(embeddings_data)} octets")
-        logging.info(f"Premiers octets des embeddings : {embeddings_data[:10]}")
-
-        if not df_clicks_sample_data or not df_recommandations_data or not embeddings_data:
-            logging.error("Erreur : Un ou plusieurs fichiers n'ont pas été téléchargés correctement")
-            return func.HttpResponse(
-                json.dumps({"error": "Un ou plusieurs fichiers n'ont pas été téléchargés correctement"}),
-                status_code=500,
-                mimetype="application/json"
+        loaded = load_artifacts(ARTIFACTS)
+    except Exception as e:
+        logging.error(f"Erreur lors du chargement des données: {e}")
+        raise
+    logging.info("Fichiers chargés avec succès.")
+    return loaded["clicks"][0], loaded["recommendations"][0], loaded["embeddings"][0]
+
+
+# Index par utilisateur construit une seule fois au chargement des données.
+# Les lignes sont regroupées par user_id dans des tableaux contigus (format CSR) :
+# les valeurs de la clé keys[i] sont columns[...][offsets[i]:offsets[i + 1]].
+class CsrTable:
+    def __init__(self, keys, offsets, columns):
+        self.keys = pd.Index(keys)  # Table de hachage : recherche d'une clé en O(1)
+        self.offsets = offsets
+        self.columns = columns
+
+    @classmethod
+    def from_columns(cls, keys, **columns):
+        keys = np.asarray(keys)
+        order = np.argsort(keys, kind="stable")  # Tri stable : l'ordre d'origine est conservé pour chaque clé
+        sorted_keys = keys[order]
+        unique_keys, starts = np.unique(sorted_keys, return_index=True)
+        offsets = np.append(starts, len(sorted_keys)).astype(np.int64)
+        return cls(unique_keys, offsets, {name: np.asarray(values)[order] for name, values in columns.items()})
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, key):
+        try:
+            return self.keys.get_loc(key)
+        except KeyError:
+            return None
+
+    def get(self, key, column, limit=None):
+        pos = self.position(key)
+        if pos is None:
+            return self.columns[column][:0]
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.columns[column][start:end]
+
+class UserIndex:
+    def __init__(self, history, recommendations, extra_history=None):
+        self.history = history                  # user_id -> articles consultés (sans doublon, ordre de première consultation)
+        self.recommendations = recommendations  # user_id -> recommandations pré-calculées (ordre du fichier)
+        # Clics ingérés depuis le chargement des artefacts : user_id -> nouveaux articles (absents de history)
+        self.extra_history = extra_history if extra_history is not None else {}
+
+    def user_history(self, user_id):
+        history = self.history.get(user_id, "article_id")
+        extra = self.extra_history.get(user_id)
+        if extra:
+            history = np.concatenate([history, np.asarray(extra, dtype=history.dtype)])
+        return history
+
+    def user_recommendations(self, user_id, top_n):
+        # Les recommandations pré-calculées d'un utilisateur qui a de nouveaux clics sont obsolètes
+        if user_id in self.extra_history:
+            return self.recommendations.columns["article_id"][:0], self.recommendations.columns["similarity_score"][:0]
+        return (self.recommendations.get(user_id, "article_id", limit=top_n),
+                self.recommendations.get(user_id, "similarity_score", limit=top_n))
+
+    # Même interface que PartitionedUserIndex : un index en mémoire est une partition unique
+    def partition_ids(self, user_ids):
+        return np.zeros(len(user_ids), dtype=np.int64)
+
+    def partition(self, partition_id):
+        return self
+
+    def with_extra_history(self, extra_history):
+        return UserIndex(self.history, self.recommendations, extra_history)
+
+    # Fonction pour lister les utilisateurs triés par user_id, avec la taille de leur historique (hors clics ingérés)
+    def user_list(self):
+        return self.history.keys.to_numpy(), np.diff(self.history.offsets)  # Clés déjà triées (CsrTable.from_columns)
+
+# Fonction pour construire l'index des utilisateurs à partir des clics et des recommandations
+def build_user_index(df_clicks_sample, df_recommandations):
+    # drop_duplicates conserve la première occurrence, comme unique() dans l'ancien get_user_history
+    clicks = df_clicks_sample[['user_id', 'click_article_id']].drop_duplicates()
+    history = CsrTable.from_columns(clicks['user_id'].to_numpy(), article_id=clicks['click_article_id'].to_numpy())
+    recommendations = CsrTable.from_columns(
+        df_recommandations['user_id'].to_numpy(),
+        article_id=df_recommandations['article_id'].to_numpy(),
+        similarity_score=df_recommandations['similarity_score'].to_numpy(),
+    )
+    logging.info(f"Index utilisateurs construit : {len(history)} historiques, {len(recommendations)} recommandations")
+    return UserIndex(history, recommendations)
+
+# Fonction pour (re)calculer les structures dérivées des artefacts qui ont changé
+def build_derived_data(data, changed):
+    if "clicks" in changed or "recommendations" in changed:
+        data["index"] = build_user_index(data["clicks"], data["recommendations"])
+    # Les recommandations recalculées par precompute_recommendations.py remplacent la table d'origine, seulement
+    # si elles ont été calculées sur la version des artefacts chargée : après une compaction (nouveaux clics),
+    # elles recommanderaient des articles déjà lus, et la table des artefacts est utilisée jusqu'au prochain job
+    shards = data.get("reco_shards")
+    if (shards and isinstance(data.get("index"), UserIndex)
+            and {"clicks", "recommendations", "columnar", "reco_shards"} & set(changed)):
+        index = data["index"]
+        if shards["artifacts_version"] == data.get("artifacts_version"):
+            data["index"] = ShardedUserIndex(index.history, index.recommendations, shards["tables"])
+        else:
+            logging.warning(f"Shards de recommandations calculés sur les artefacts {shards['artifacts_version']}, "
+                            f"artefacts chargés {data.get('artifacts_version')} : shards ignorés.")
+            data["index"] = UserIndex(index.history, index.recommendations)
+    if {"clicks", "recommendations", "columnar", "partitions"} & set(changed):
+        data["users"] = data["index"].user_list()
+    stored_norm = data.get("embeddings_norm") if {"columnar", "partitions"} & set(changed) else None
+    if stored_norm is not None and EMBEDDINGS_PRECISION in ("auto", stored_norm.dtype.name):
+        # Embeddings normalisés des artefacts, en mémoire mappée (missing_articles est chargé avec eux)
+        logging.info(f"Embeddings normalisés en {stored_norm.dtype.name} lus depuis les artefacts.")
+    elif "embeddings" in changed or "columnar" in changed or "partitions" in changed:
+        data["embeddings_norm"] = None  # L'ancienne matrice n'entre pas dans l'estimation du budget mémoire
+        embeddings_norm = normalize_embeddings(data["embeddings"])
+        # Articles sans embedding (lignes nulles, par exemple laissées par l'ingestion) : jamais recommandés
+        data["missing_articles"] = np.flatnonzero(~embeddings_norm.any(axis=1))
+        data["embeddings_norm"] = quantize_embeddings(embeddings_norm, choose_embeddings_precision(data, embeddings_norm.shape))
+    if changed:
+        footprint = memory_footprint(data)
+        logging.info(f"Empreinte mémoire des données : {footprint['resident_bytes'] / 1e6:.1f} Mo résidents, "
+                     f"{footprint['mapped_bytes'] / 1e6:.1f} Mo mappés "
+                     + ", ".join(f"{name} {usage['bytes'] / 1e6:.1f} Mo" for name, usage in footprint["structures"].items()))
+    return data
+
+# Fonction pour savoir si un tableau est en mémoire mappée (pages partagées avec le cache système)
+def is_mapped(array):
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+# Fonction pour mesurer l'empreinte mémoire de chaque structure chargée. Retourne les octets par structure,
+# dont ceux en mémoire mappée (artefacts colonnaires), et les totaux résidents / mappés
+def memory_footprint(data):
+    def arrays_of(value):
+        if value is None:
+            return []
+        if isinstance(value, pd.DataFrame):
+            index = [] if isinstance(value.index, pd.RangeIndex) else [value.index.to_numpy()]  # RangeIndex : aucun tableau
+            return [value[column].to_numpy() for column in value.columns] + index
+        if isinstance(value, CsrTable):
+            return [value.keys.to_numpy(), value.offsets, *value.columns.values()]
+        if isinstance(value, ShardedUserIndex):
+            return (arrays_of(value.history) + arrays_of(value.recommendations)
+                    + [array for table in value.shards for array in arrays_of(table)])
+        if isinstance(value, UserIndex):
+            return arrays_of(value.history) + arrays_of(value.recommendations)
+        if isinstance(value, PartitionedUserIndex):
+            return [array for partition in value.loaded_partitions() for array in arrays_of(partition)]
+        if isinstance(value, tuple):
+            return [array for item in value for array in arrays_of(item)]
+        if isinstance(value, IvfIndex):
+            return [a for a in (value.centroids, value.list_offsets, value.list_ids, value.pq_codebooks, value.pq_codes) if a is not None]
+        return [np.asarray(value)]
+
+    # Déduplication sur le tampon (adresse, taille) et non sur id() : to_numpy() et np.asarray() renvoient des
+    # objets temporaires dont l'id peut être réutilisé. Les tableaux comptés restent référencés jusqu'à la fin
+    structures, seen, counted = {}, set(), []
+    for name in ("clicks", "recommendations", "embeddings", "embeddings_norm", "index", "ann", "users"):
+        usage = {"bytes": 0, "mapped_bytes": 0}
+        for array in arrays_of(data.get(name)):
+            key = (array.__array_interface__["data"][0], array.nbytes)
+            if key in seen:  # Tableau partagé entre deux structures (par exemple un DataFrame et l'index)
+                continue
+            seen.add(key)
+            counted.append(array)
+            size = array.nbytes if array.dtype != object else int(pd.Series(array).memory_usage(deep=True, index=False))
+            usage["bytes"] += size
+            usage["mapped_bytes"] += size if is_mapped(array) else 0
+        structures[name] = usage
+    mapped = sum(usage["mapped_bytes"] for usage in structures.values())
+    return {"structures": structures, "resident_bytes": sum(usage["bytes"] for usage in structures.values()) - mapped,
+            "mapped_bytes": mapped}
+
+# Fonction pour choisir le type des embeddings normalisés. En mode auto, les embeddings d'origine résidents en
+# float64 passent d'abord en float32, puis c'est le plus précis (float32, puis float16, puis int8) pour lequel
+# l'empreinte résidente estimée des données tient dans MEMORY_BUDGET_MB. Sans budget : int8 en mode compact
+# (les meilleurs candidats sont re-classés en float32), float32 sinon
+def choose_embeddings_precision(data, shape):
+    if EMBEDDINGS_PRECISION != "auto":
+        return EMBEDDINGS_PRECISION
+    embeddings = data.get("embeddings")
+    if embeddings is not None and embeddings.dtype == np.float64 and not is_mapped(embeddings):
+        logging.info(f"Embeddings d'origine convertis de float64 en float32 ({embeddings.nbytes / 2e6:.1f} Mo libérés)")
+        data["embeddings"] = embeddings.astype(np.float32)
+    budget = MEMORY_BUDGET_MB * 1e6
+    if budget <= 0:
+        return EMBEDDINGS_PRECISIONS[-1] if MEMORY_MODE == "compact" else EMBEDDINGS_PRECISIONS[0]
+    others = memory_footprint(data)["resident_bytes"]
+    for precision in EMBEDDINGS_PRECISIONS:
+        needed = others + shape[0] * shape[1] * np.dtype(precision).itemsize
+        if needed <= budget:
+            logging.info(f"Embeddings normalisés en {precision} : {needed / 1e6:.1f} Mo estimés (budget {MEMORY_BUDGET_MB:.0f} Mo)")
+            return precision
+    logging.warning(f"Budget mémoire de {MEMORY_BUDGET_MB:.0f} Mo dépassé même en int8 ({needed / 1e6:.1f} Mo estimés).")
+    return EMBEDDINGS_PRECISIONS[-1]
+
+
+# Fonction pour choisir le type des embeddings normalisés écrits dans les artefacts (float32 en mode auto : le
+# choix est refait au chargement, où une matrice mappée ne compte pas dans le budget résident)
+def stored_embeddings_precision():
+    return EMBEDDINGS_PRECISION if EMBEDDINGS_PRECISION != "auto" else "float32"
+
+# Fonction pour calculer les colonnes dérivées des embeddings écrites dans les artefacts : matrice normalisée
+# (dans le type demandé) et articles sans embedding (lignes nulles, jamais recommandés)
+def normalized_embedding_columns(embeddings, precision):
+    embeddings_norm = normalize_embeddings(embeddings)
+    return {
+        "embeddings_norm": quantize_embeddings(embeddings_norm, precision),
+        "missing_articles": np.flatnonzero(~embeddings_norm.any(axis=1)),
+    }
+
+
+# 4 ter. Format binaire colonnaire (memory-mapped)
+# Les artefacts convertis par convert_artifacts.py sont rangés dans ARTIFACTS_DIR :
+#   manifest.json           -> version courante et description des colonnes
+#   <version>/<colonne>.npy -> une colonne typée par fichier (.npy : en-tête court + données brutes)
+# Les fichiers sont ouverts avec np.load(mmap_mode="r") : le démarrage à froid ne parse rien et
+# les workers d'une même machine partagent les pages du cache système au lieu d'avoir chacun une copie.
+# Les embeddings normalisés (dans le type EMBEDDINGS_PRECISION) y sont aussi écrits : aucun worker n'en garde
+# une copie résidente, sauf si le type demandé au chargement diffère de celui des artefacts.
+# Chaque conversion écrit un nouveau sous-dossier puis remplace le manifest : un fichier déjà mappé
+# par un worker n'est jamais réécrit en place.
+ARTIFACTS_DIR = os.getenv("ARTIFACTS_DIR")
+ARTIFACTS_FORMAT_VERSION = 1
+ARTIFACTS_MANIFEST = "manifest.json"
+# Nombre de groupes IVF parcourus par requête quand un index ANN est disponible (compromis rappel / latence)
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))
+
+# Fonction pour lire le manifest des artefacts colonnaires (None s'il n'existe pas)
+def read_artifacts_manifest(directory):
+    path = os.path.join(directory, ARTIFACTS_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != ARTIFACTS_FORMAT_VERSION:
+        raise ValueError(f"Version de format d'artefacts non supportée : {manifest.get('format_version')}")
+    return manifest
+
+# Fonction pour choisir le plus petit type entier capable de représenter des identifiants
+def smallest_int_dtype(values):
+    if len(values) == 0:
+        return np.dtype(np.int32)
+    low, high = int(np.min(values)), int(np.max(values))
+    for dtype in (np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("Identifiants hors de l'intervalle int64")
+
+# Fonction pour calculer l'ETag des artefacts colonnaires : il change aussi quand un index ANN est ajouté
+def manifest_etag(manifest):
+    return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()[:12]
+
+# Fonction pour écrire les artefacts au format colonnaire. Retourne le manifest écrit
+def write_columnar_artifacts(directory, df_clicks_sample, df_recommandations, embeddings_2D, version=None, ann_index=None,
+                             embeddings_precision=None):
+    if embeddings_2D.dtype == object:
+        embeddings_2D = np.stack(embeddings_2D)
+    embeddings = np.ascontiguousarray(embeddings_2D, dtype=np.float32)
+    user_index = build_user_index(df_clicks_sample, df_recommandations)
+
+    columns = {
+        "clicks_user_id": df_clicks_sample['user_id'].to_numpy(),
+        "clicks_article_id": df_clicks_sample['click_article_id'].to_numpy(),
+        "reco_user_id": df_recommandations['user_id'].to_numpy(),
+        "reco_article_id": df_recommandations['article_id'].to_numpy(),
+        "reco_similarity_score": df_recommandations['similarity_score'].to_numpy(),
+        "history_keys": user_index.history.keys.to_numpy(),
+        "history_offsets": user_index.history.offsets,
+        "history_article_id": user_index.history.columns["article_id"],
+        "reco_keys": user_index.recommendations.keys.to_numpy(),
+        "reco_offsets": user_index.recommendations.offsets,
+        "reco_index_article_id": user_index.recommendations.columns["article_id"],
+        "reco_index_similarity_score": user_index.recommendations.columns["similarity_score"],
+        "embeddings": embeddings,
+        **normalized_embedding_columns(embeddings, embeddings_precision or stored_embeddings_precision()),
+    }
+    for name, values in columns.items():
+        if values.dtype.kind in "iu" and not name.endswith("_offsets") and name != "embeddings_norm":
+            columns[name] = values.astype(smallest_int_dtype(values))
+
+    if version is None:
+        digest = hashlib.sha1()
+        for name in sorted(columns):
+            digest.update(name.encode())
+            digest.update(np.ascontiguousarray(columns[name]).tobytes())
+        version = digest.hexdigest()[:12]
+
+    # Une version déjà présente n'est pas réécrite (elle peut être mappée par un worker)
+    version_dir = os.path.join(directory, version)
+    if not os.path.isdir(version_dir):
+        tmp_dir = version_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, values in columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), np.ascontiguousarray(values), allow_pickle=False)
+        os.replace(tmp_dir, version_dir)
+
+    manifest = {
+        "format_version": ARTIFACTS_FORMAT_VERSION,
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "n_clicks": len(df_clicks_sample),
+        "n_recommendations": len(df_recommandations),
+        "n_users": len(user_index.history),
+        "embeddings_shape": list(embeddings.shape),
+        "columns": {name: str(values.dtype) for name, values in columns.items()},
+    }
+    if ann_index is not None:
+        manifest["ann"] = ann_index.save(version_dir)
+    # Le manifest est remplacé en dernier et de façon atomique : il ne pointe jamais vers une version incomplète
+    tmp_path = os.path.join(directory, ARTIFACTS_MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, ARTIFACTS_MANIFEST))
+    return manifest
+
+# Fonction pour supprimer les anciennes versions des artefacts. On garde la version courante et la précédente,
+# qui peut encore être mappée par des workers qui n'ont pas rechargé.
+def prune_artifact_versions(directory, keep=2):
+    current = read_artifacts_manifest(directory)["version"]
+    versions = [entry for entry in os.scandir(directory) if entry.is_dir() and entry.name != current]
+    versions.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[max(keep - 1, 0):]:
+        logging.info(f"Suppression de l'ancienne version d'artefacts {entry.name}")
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+# Fonction pour charger les artefacts colonnaires en mémoire mappée. Retourne (données, version)
+def load_columnar_artifacts(directory):
+    manifest = read_artifacts_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(f"Aucun manifest d'artefacts dans {directory}")
+    base = os.path.join(directory, manifest["version"])
+
+    def column(name):
+        return np.load(os.path.join(base, f"{name}.npy"), mmap_mode="r", allow_pickle=False)
+
+    # Artefacts écrits avant l'ajout des embeddings normalisés : matrice recalculée au chargement
+    stored_norm = "embeddings_norm" in manifest["columns"]
+    user_index = UserIndex(
+        CsrTable(column("history_keys"), column("history_offsets"), {"article_id": column("history_article_id")}),
+        CsrTable(column("reco_keys"), column("reco_offsets"), {
+            "article_id": column("reco_index_article_id"),
+            "similarity_score": column("reco_index_similarity_score"),
+        }),
+    )
+    data = {
+        "clicks": pd.DataFrame({"user_id": column("clicks_user_id"),
+                                "click_article_id": column("clicks_article_id")}, copy=False),
+        "recommendations": pd.DataFrame({"user_id": column("reco_user_id"),
+                                         "article_id": column("reco_article_id"),
+                                         "similarity_score": column("reco_similarity_score")}, copy=False),
+        "embeddings": column("embeddings"),
+        "embeddings_norm": column("embeddings_norm") if stored_norm else None,
+        "missing_articles": column("missing_articles") if stored_norm else None,
+        "index": user_index,
+        "ann": IvfIndex.load(base) if manifest.get("ann") else None,
+        "artifacts_version": manifest["version"],
+    }
+    logging.info(f"Artefacts colonnaires version {manifest['version']} chargés depuis {base}")
+    return data, manifest_etag(manifest)
+
+# Recommandations pré-calculées par precompute_recommendations.py : shards au format CSR dans
+# RECOMMENDATIONS_SHARDS_DIR, utilisés une fois le manifest écrit (c'est-à-dire le job terminé)
+RECOMMENDATIONS_SHARDS_DIR = os.getenv("RECOMMENDATIONS_SHARDS_DIR")
+RECO_SHARDS_MANIFEST = "manifest.json"
+RECO_SHARDS_COLUMNS = ("user_id", "offsets", "article_id", "similarity_score")
+
+# Fonction pour construire le chemin d'une colonne d'un shard de recommandations
+def reco_shard_path(directory, shard_id, name):
+    return os.path.join(directory, f"shard-{shard_id:05d}.{name}.npy")
+
+# Fonction pour savoir si des shards de recommandations complets sont disponibles
+def use_reco_shards():
+    return bool(RECOMMENDATIONS_SHARDS_DIR) and os.path.exists(os.path.join(RECOMMENDATIONS_SHARDS_DIR, RECO_SHARDS_MANIFEST))
+
+# Fonction pour lire le manifest des shards de recommandations
+def read_reco_shards_manifest(directory):
+    with open(os.path.join(directory, RECO_SHARDS_MANIFEST), encoding="utf-8") as f:
+        return json.load(f)
+
+# Fonction pour ouvrir les shards de recommandations en mémoire mappée, une table CSR par shard (rien n'est
+# copié en mémoire résidente). Retourne ({"tables": tables dans l'ordre des user_id, "artifacts_version"}, etag)
+def load_recommendation_shards(directory):
+    manifest = read_reco_shards_manifest(directory)
+    tables = []
+    for shard_id in range(manifest["n_shards"]):
+        shard = {name: np.load(reco_shard_path(directory, shard_id, name), mmap_mode="r", allow_pickle=False)
+                 for name in RECO_SHARDS_COLUMNS}
+        if len(shard["user_id"]):
+            tables.append(CsrTable(shard["user_id"], shard["offsets"], {"article_id": shard["article_id"],
+                                                                        "similarity_score": shard["similarity_score"]}))
+    logging.info(f"Recommandations pré-calculées ouvertes depuis {manifest['n_shards']} shards "
+                 f"({sum(len(table) for table in tables)} utilisateurs)")
+    return {"tables": tables, "artifacts_version": manifest.get("artifacts_version")}, manifest_etag(manifest)
+
+# Index des utilisateurs dont les recommandations sont lues dans les shards de precompute_recommendations.py.
+# Chaque shard couvre une plage contiguë de user_id (positions de l'index trié) : une recherche ne touche
+# que le shard de l'utilisateur, comme PartitionedUserIndex avec ses partitions
+class ShardedUserIndex(UserIndex):
+    def __init__(self, history, recommendations, shards, extra_history=None):
+        super().__init__(history, recommendations, extra_history)  # Table des artefacts, gardée si les shards sont ignorés
+        self.shards = shards
+        self.shard_starts = np.array([table.keys[0] for table in shards], dtype=np.int64)
+
+    def partition_ids(self, user_ids):
+        return np.maximum(np.searchsorted(self.shard_starts, np.asarray(user_ids, dtype=np.int64), side="right") - 1, 0)
+
+    def partition(self, partition_id):
+        return UserIndex(self.history, self.shards[partition_id], self.extra_history)
+
+    def user_recommendations(self, user_id, top_n):
+        return self.partition(self.partition_ids([user_id])[0]).user_recommendations(user_id, top_n)
+
+    def with_extra_history(self, extra_history):
+        return ShardedUserIndex(self.history, self.recommendations, self.shards, extra_history)
+
+# Partitions d'utilisateurs : pour les jeux de données plus grands que la mémoire d'un worker, l'historique et
+# les recommandations sont répartis par hachage de user_id en USER_PARTITIONS partitions (convert_artifacts.py
+# --partitions) rangées dans USER_PARTITIONS_DIR :
+#   manifest.json                              -> version courante, nombre de partitions, utilisateurs par partition
+#   <version>/embeddings.npy                   -> embeddings (communs à tous les utilisateurs)
+#   <version>/part-00000.<colonne>.npy         -> tables CSR de la partition (history_*, reco_*)
+#   <version>/users.<colonne>.npy              -> liste triée de tous les utilisateurs (user_id, history_count)
+# Au démarrage seuls le manifest et les embeddings sont ouverts ; une requête ne charge que la partition de son
+# utilisateur, et les USER_PARTITIONS_CACHE partitions les plus récemment utilisées restent ouvertes.
+USER_PARTITIONS_DIR = os.getenv("USER_PARTITIONS_DIR")
+USER_PARTITIONS_CACHE = int(os.getenv("USER_PARTITIONS_CACHE", "16"))
+USER_PARTITION_COLUMNS = ("history_keys", "history_offsets", "history_article_id",
+                          "reco_keys", "reco_offsets", "reco_article_id", "reco_similarity_score")
+USER_LIST_COLUMNS = ("user_id", "history_count")  # Liste triée de tous les utilisateurs (route /users)
+PARTITION_HASH = 0x9E3779B97F4A7C15  # Hachage multiplicatif (Fibonacci) sur 64 bits
+PARTITION_HASH_MASK = (1 << 64) - 1
+
+# Fonction pour calculer la partition de user_ids (tableau). Le hachage répartit aussi les identifiants
+# séquentiels ou de même parité, et ne dépend pas du processus (contrairement à hash())
+def user_partitions(user_ids, n_partitions):
+    hashed = np.asarray(user_ids).astype(np.uint64) * np.uint64(PARTITION_HASH)  # Modulo 2**64
+    return ((hashed >> np.uint64(32)) % np.uint64(n_partitions)).astype(np.int64)
+
+# Fonction pour calculer la partition d'un seul user_id (même résultat que user_partitions, sans tableau numpy)
+def user_partition(user_id, n_partitions):
+    return (((int(user_id) * PARTITION_HASH) & PARTITION_HASH_MASK) >> 32) % n_partitions
+
+# Fonction pour construire le chemin d'une colonne d'une partition
+def user_partition_path(version_dir, partition_id, name):
+    return os.path.join(version_dir, f"part-{partition_id:05d}.{name}.npy")
+
+# Fonction pour écrire les artefacts partitionnés par utilisateur. Retourne le manifest écrit
+def write_user_partitions(directory, df_clicks_sample, df_recommandations, embeddings_2D, n_partitions, version=None,
+                          embeddings_precision=None):
+    if embeddings_2D.dtype == object:
+        embeddings_2D = np.stack(embeddings_2D)
+    embeddings = np.ascontiguousarray(embeddings_2D, dtype=np.float32)
+    embedding_columns = normalized_embedding_columns(embeddings, embeddings_precision or stored_embeddings_precision())
+    clicks = df_clicks_sample[['user_id', 'click_article_id']].drop_duplicates()
+    click_parts = user_partitions(clicks['user_id'].to_numpy(), n_partitions)
+    reco_parts = user_partitions(df_recommandations['user_id'].to_numpy(), n_partitions)
+
+    partitions, n_users, users = [], [], []
+    for partition_id in range(n_partitions):
+        part_clicks = clicks[click_parts == partition_id]
+        part_reco = df_recommandations[reco_parts == partition_id]
+        index = build_user_index(part_clicks, part_reco)
+        columns = {
+            "history_keys": index.history.keys.to_numpy(),
+            "history_offsets": index.history.offsets,
+            "history_article_id": index.history.columns["article_id"],
+            "reco_keys": index.recommendations.keys.to_numpy(),
+            "reco_offsets": index.recommendations.offsets,
+            "reco_article_id": index.recommendations.columns["article_id"],
+            "reco_similarity_score": index.recommendations.columns["similarity_score"],
+        }
+        for name, values in columns.items():
+            if values.dtype.kind in "iu" and not name.endswith("_offsets"):
+                columns[name] = values.astype(smallest_int_dtype(values))
+        partitions.append(columns)
+        n_users.append(len(index.history))
+        users.append(index.user_list())
+
+    user_ids = np.concatenate([user_ids for user_ids, _ in users])
+    order = np.argsort(user_ids, kind="stable")
+    user_list = {"user_id": user_ids[order].astype(smallest_int_dtype(user_ids)),
+                 "history_count": np.concatenate([counts for _, counts in users])[order].astype(np.int32)}
+
+    if version is None:
+        digest = hashlib.sha1(embeddings.tobytes())
+        digest.update(embedding_columns["embeddings_norm"].tobytes())
+        for partition_id, columns in enumerate(partitions):
+            for name in USER_PARTITION_COLUMNS:
+                digest.update(f"{partition_id}.{name}".encode())
+                digest.update(np.ascontiguousarray(columns[name]).tobytes())
+        version = digest.hexdigest()[:12]
+
+    # Comme pour les artefacts colonnaires : dossier temporaire, version existante jamais réécrite
+    version_dir = os.path.join(directory, version)
+    if not os.path.isdir(version_dir):
+        tmp_dir = version_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings, allow_pickle=False)
+        for name, values in embedding_columns.items():
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values, allow_pickle=False)
+        for partition_id, columns in enumerate(partitions):
+            for name, values in columns.items():
+                np.save(user_partition_path(tmp_dir, partition_id, name), np.ascontiguousarray(values), allow_pickle=False)
+        for name in USER_LIST_COLUMNS:
+            np.save(os.path.join(tmp_dir, f"users.{name}.npy"), user_list[name], allow_pickle=False)
+        os.replace(tmp_dir, version_dir)
+
+    manifest = {
+        "format_version": ARTIFACTS_FORMAT_VERSION,
+        "layout": "user_partitions",
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "n_partitions": n_partitions,
+        "n_clicks": len(df_clicks_sample),
+        "n_recommendations": len(df_recommandations),
+        "n_users": sum(n_users),
+        "partition_users": n_users,
+        "embeddings_shape": list(embeddings.shape),
+        "embeddings_norm_dtype": str(embedding_columns["embeddings_norm"].dtype),
+    }
+    tmp_path = os.path.join(directory, ARTIFACTS_MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(directory, ARTIFACTS_MANIFEST))
+    return manifest
+
+# Partitions ouvertes (LRU) : (dossier de version, partition) -> UserIndex de la partition
+_partition_cache = OrderedDict()
+_partition_cache_lock = threading.Lock()
+_partition_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Index des utilisateurs réparti en partitions chargées à la demande (même interface que UserIndex)
+class PartitionedUserIndex:
+    def __init__(self, version_dir, n_partitions, extra_history=None):
+        self.version_dir = version_dir
+        self.n_partitions = n_partitions
+        self.extra_history = extra_history if extra_history is not None else {}
+
+    def partition_ids(self, user_ids):
+        return user_partitions(user_ids, self.n_partitions)
+
+    # Fonction pour récupérer l'index d'une partition (ouverte en mémoire mappée au premier accès)
+    def partition(self, partition_id):
+        key = (self.version_dir, int(partition_id))
+        with _partition_cache_lock:
+            index = _partition_cache.get(key)
+            if index is not None:
+                _partition_cache.move_to_end(key)
+                _partition_cache_stats["hits"] += 1
+        if index is None:
+            index = self.load_partition(partition_id)
+            with _partition_cache_lock:
+                _partition_cache_stats["misses"] += 1
+                _partition_cache[key] = index
+                while len(_partition_cache) > USER_PARTITIONS_CACHE:
+                    _partition_cache.popitem(last=False)
+                    _partition_cache_stats["evictions"] += 1
+        return index.with_extra_history(self.extra_history) if self.extra_history else index
+
+    def load_partition(self, partition_id):
+        with timed_stage("load"):
+            columns = {name: np.load(user_partition_path(self.version_dir, partition_id, name), mmap_mode="r", allow_pickle=False)
+                       for name in USER_PARTITION_COLUMNS}
+            return UserIndex(
+                CsrTable(columns["history_keys"], columns["history_offsets"], {"article_id": columns["history_article_id"]}),
+                CsrTable(columns["reco_keys"], columns["reco_offsets"], {"article_id": columns["reco_article_id"],
+                                                                         "similarity_score": columns["reco_similarity_score"]}),
             )
-        else :
-            logging.info("Données téléchargées. Chargement des fichiers...")
 
-        # Charger les embeddings depuis la mémoire
+    # Fonction pour lister les partitions de cet index actuellement ouvertes
+    def loaded_partitions(self):
+        with _partition_cache_lock:
+            return [index for (version_dir, _), index in _partition_cache.items() if version_dir == self.version_dir]
+
+    def user_history(self, user_id):
+        return self.partition(user_partition(user_id, self.n_partitions)).user_history(user_id)
+
+    def user_recommendations(self, user_id, top_n):
+        return self.partition(user_partition(user_id, self.n_partitions)).user_recommendations(user_id, top_n)
+
+    def with_extra_history(self, extra_history):
+        return PartitionedUserIndex(self.version_dir, self.n_partitions, extra_history)
+
+    # La liste triée de tous les utilisateurs est pré-calculée par write_user_partitions (aucune partition chargée)
+    def user_list(self):
+        return tuple(np.load(os.path.join(self.version_dir, f"users.{name}.npy"), mmap_mode="r", allow_pickle=False)
+                     for name in USER_LIST_COLUMNS)
+
+# Fonction pour savoir si des artefacts partitionnés par utilisateur sont disponibles
+def use_user_partitions():
+    return bool(USER_PARTITIONS_DIR) and os.path.exists(os.path.join(USER_PARTITIONS_DIR, ARTIFACTS_MANIFEST))
+
+# Fonction pour ouvrir les artefacts partitionnés (manifest et embeddings seulement). Retourne (données, etag)
+def load_user_partitions(directory):
+    manifest = read_artifacts_manifest(directory)
+    version_dir = os.path.join(directory, manifest["version"])
+
+    def load(name):
+        return np.load(os.path.join(version_dir, f"{name}.npy"), mmap_mode="r", allow_pickle=False)
+
+    stored_norm = "embeddings_norm_dtype" in manifest
+    data = {
+        "embeddings": load("embeddings"),
+        "embeddings_norm": load("embeddings_norm") if stored_norm else None,
+        "missing_articles": load("missing_articles") if stored_norm else None,
+        "index": PartitionedUserIndex(version_dir, manifest["n_partitions"]),
+        # Index ANN construit par "python ann_index.py build <USER_PARTITIONS_DIR>" (commun à toutes les partitions)
+        "ann": IvfIndex.load(version_dir) if manifest.get("ann") else None,
+    }
+    logging.info(f"Artefacts partitionnés version {manifest['version']} : {manifest['n_partitions']} partitions, "
+                 f"{manifest['n_users']} utilisateurs")
+    return data, manifest_etag(manifest)
+
+# Fonction pour exposer l'état du cache des partitions
+def get_partition_cache_stats():
+    with _partition_cache_lock:
+        return {**_partition_cache_stats, "open": len(_partition_cache), "max_open": USER_PARTITIONS_CACHE}
+
+# Fonction pour savoir si les artefacts colonnaires sont disponibles (sinon repli sur CSV / JSON / npy)
+def use_columnar_artifacts():
+    return bool(ARTIFACTS_DIR) and os.path.exists(os.path.join(ARTIFACTS_DIR, ARTIFACTS_MANIFEST))
+
+# Fonction pour lire les ETags courants des artefacts (sans téléchargement)
+def get_artifact_etags():
+    if use_user_partitions():
+        return {"partitions": manifest_etag(read_artifacts_manifest(USER_PARTITIONS_DIR))}
+    if use_columnar_artifacts():
+        etags = {"columnar": manifest_etag(read_artifacts_manifest(ARTIFACTS_DIR))}
+    else:
+        etags = {name: get_blob_etag(url) for name, (url, _) in ARTIFACTS.items()}
+    if use_reco_shards():
+        etags["reco_shards"] = manifest_etag(read_reco_shards_manifest(RECOMMENDATIONS_SHARDS_DIR))
+    return etags
+
+# Fonction pour charger les artefacts indiqués (tous par défaut). Retourne (données chargées, etags).
+# Les artefacts colonnaires sont toujours chargés ensemble : ils contiennent déjà l'index des utilisateurs.
+# Les artefacts partitionnés, s'ils sont disponibles, sont prioritaires
+def load_changed_artifacts(names=None):
+    data, etags = {}, {}
+    if use_user_partitions():
+        if names is None or "partitions" in names:
+            with timed_stage("load"):
+                data, etags["partitions"] = load_user_partitions(USER_PARTITIONS_DIR)
+        return data, etags
+    if use_columnar_artifacts():
+        if names is None or "columnar" in names:
+            with timed_stage("load"):
+                data, etag = load_columnar_artifacts(ARTIFACTS_DIR)
+            etags["columnar"] = etag
+    else:
+        loaded = load_artifacts([name for name in ARTIFACTS if names is None or name in names])
+        data = {name: value for name, (value, _) in loaded.items()}
+        etags = {name: etag for name, (_, etag) in loaded.items()}
+    if use_reco_shards() and (names is None or "reco_shards" in names):
+        with timed_stage("load"):
+            data["reco_shards"], etags["reco_shards"] = load_recommendation_shards(RECOMMENDATIONS_SHARDS_DIR)
+    return data, etags
+
+
+# 4 bis. Cache des données au niveau du processus
+# Les artefacts sont chargés une seule fois par worker puis servis depuis la mémoire.
+# Passé DATA_CACHE_TTL secondes, les ETags des blobs sont revérifiés en arrière-plan
+# (la requête en cours est servie avec les données déjà en mémoire) et seuls les
+# artefacts modifiés sont re-téléchargés.
+DATA_CACHE_TTL = float(os.getenv("DATA_CACHE_TTL", "300"))
+
+_data_cache = {"data": None, "etags": {}, "version": None, "checked_at": 0.0, "revalidating": False}
+_data_cache_lock = threading.Lock()
+_data_cache_stats = {"hits": 0, "misses": 0, "reloads": 0, "revalidations": 0, "errors": 0}
+
+# Fonction pour calculer une version courte des données à partir des ETags des artefacts
+def compute_data_version(etags):
+    key = "|".join(f"{name}:{etags.get(name)}" for name in sorted(etags))
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+# Fonction pour installer un nouveau jeu de données dans le cache (appelée sous verrou).
+# Les articles ingérés non encore compactés sont reflétés dans la version (suffixe dérivé de leur contenu, identique
+# d'un worker à l'autre pour les mêmes articles). Les clics ne changent pas la version : ils ne concernent que les
+# réponses des utilisateurs qui ont cliqué (voir user_history_tag).
+def _set_cached_data(data, etags):
+    _data_cache["data"] = data
+    _data_cache["etags"] = etags
+    _data_cache["version"] = compute_data_version(etags)
+    if _ingest_state["articles"]:
+        _data_cache["version"] += f"-{_ingest_state['articles_digest'][:8]}"
+    _data_cache["checked_at"] = time.monotonic()
+    data["version"] = _data_cache["version"]
+
+# Fonction pour revérifier les ETags et recharger uniquement les artefacts modifiés
+def revalidate_data_cache():
+    try:
+        _data_cache_stats["revalidations"] += 1
+        etags = get_artifact_etags()
+        changed = [name for name in etags if etags[name] != _data_cache["etags"].get(name)]
+        if not changed:
+            with _data_cache_lock:
+                _data_cache["checked_at"] = time.monotonic()
+            return
+
+        logging.info(f"Artefacts modifiés depuis le dernier chargement : {changed}")
+        loaded, loaded_etags = load_changed_artifacts(changed)
+        # Les structures dérivées sont reconstruites hors verrou : les requêtes continuent
+        # d'être servies avec l'ancien jeu de données jusqu'à la bascule
+        current = _data_cache["data"]
+        data = build_derived_data({**current.get("base", current), **loaded}, loaded_etags)
+        # Les événements ingérés et pas encore compactés sont ré-appliqués sur les nouveaux artefacts
+        with _ingest_lock:
+            data = apply_ingested_events(data, _ingest_state["clicks"], _ingest_state["articles"])
+            with _data_cache_lock:
+                _set_cached_data(data, {**etags, **loaded_etags})
+                _data_cache_stats["reloads"] += 1
+    except Exception as e:
+        # En cas d'échec on continue à servir les données en mémoire et on réessaiera au prochain TTL
+        _data_cache_stats["errors"] += 1
+        logging.error(f"Erreur lors de la revalidation du cache de données : {e}")
+        with _data_cache_lock:
+            _data_cache["checked_at"] = time.monotonic()
+    finally:
+        _data_cache["revalidating"] = False
+
+# Fonction pour récupérer les données depuis le cache (chargement complet au premier appel)
+def get_data():
+    with _data_cache_lock:
+        if _data_cache["data"] is None:
+            _data_cache_stats["misses"] += 1
+            data, etags = load_changed_artifacts()
+            with timed_stage("index"):
+                data = build_derived_data(data, etags)
+            _set_cached_data(data, etags)
+            return _data_cache["data"]
+
+        _data_cache_stats["hits"] += 1
+        expired = time.monotonic() - _data_cache["checked_at"] >= DATA_CACHE_TTL
+        if expired and not _data_cache["revalidating"]:
+            _data_cache["revalidating"] = True
+            threading.Thread(target=revalidate_data_cache, daemon=True).start()
+        return _data_cache["data"]
+
+# Fonction pour exposer l'état et les compteurs du cache
+def get_data_cache_stats():
+    ingest_stats = get_ingest_stats()  # Hors du verrou du cache : l'ingestion prend les verrous dans l'ordre inverse
+    with _data_cache_lock:
+        return {
+            **_data_cache_stats,
+            "version": _data_cache["version"],
+            "etags": dict(_data_cache["etags"]),
+            "age_seconds": round(time.monotonic() - _data_cache["checked_at"], 1) if _data_cache["data"] is not None else None,
+            "ttl_seconds": DATA_CACHE_TTL,
+            "ingest": ingest_stats,
+            "responses": get_response_cache_stats(),
+            "partitions": get_partition_cache_stats() if use_user_partitions() else None,
+            "memory": memory_footprint(_data_cache["data"]) if _data_cache["data"] is not None else None,
+        }
+
+# 4 quater. Ingestion incrémentale de clics et d'articles
+# Les événements ingérés sont appliqués aux structures en mémoire sans recharger les artefacts :
+#   - clics : ajoutés à l'historique des utilisateurs (UserIndex.extra_history), dont les recommandations
+#     pré-calculées sont alors ignorées au profit du calcul en ligne ;
+#   - articles : lignes ajoutées (ou remplacées) dans les matrices d'embeddings, qui ont une capacité de
+#     réserve (croissance amortie), et rangés dans le groupe IVF le plus proche si un index ANN est chargé.
+# Le coût d'une ingestion est proportionnel au nombre d'événements. Les événements sont conservés jusqu'à la
+# compaction suivante, qui les écrit dans de nouveaux artefacts colonnaires (ARTIFACTS_DIR requis) : les autres
+# workers les voient à ce moment-là, au plus DATA_CACHE_TTL secondes après.
+# Sans artefacts colonnaires (déploiement par défaut, blobs CSV / JSON / npy) ou avec des partitions
+# d'utilisateurs, il n'y a pas de compaction : les événements restent dans la mémoire du worker qui les a reçus,
+# sont perdus à son redémarrage ("persisted": false dans la réponse de /ingest) et sont refusés (503) au-delà
+# de INGEST_MAX_PENDING_EVENTS.
+INGEST_COMPACT_INTERVAL = float(os.getenv("INGEST_COMPACT_INTERVAL", "300"))  # Secondes entre deux compactions
+INGEST_COMPACT_MAX_EVENTS = int(os.getenv("INGEST_COMPACT_MAX_EVENTS", "10000"))  # Compaction anticipée au-delà
+INGEST_MAX_PENDING_EVENTS = int(os.getenv("INGEST_MAX_PENDING_EVENTS", "100000"))  # Sans compaction possible
+INGEST_MAX_ARTICLE_GAP = 10000  # Écart maximal entre un nouvel article_id et la taille actuelle de la matrice
+
+_ingest_state = {
+    "clicks": [],        # [(user_id, article_id)] pas encore compactés
+    "articles": {},      # article_id -> embedding, pas encore compactés
+    "articles_digest": "",  # Empreinte des lots d'articles en attente (suffixe de la version des données)
+    "buffers": {},       # Matrices avec capacité de réserve : nom -> tableau
+    "last_compaction": time.monotonic(),
+    "compacting": False,
+}
+_ingest_lock = threading.Lock()
+_compaction_lock = threading.Lock()  # Une seule compaction à la fois (tâche de fond ou ?compact=true)
+_ingest_stats = {"clicks": 0, "articles": 0, "rejected": 0, "compactions": 0, "compaction_errors": 0}
+
+# Fonction pour écrire des lignes dans une matrice d'embeddings en gardant une capacité de réserve.
+# Tant que la capacité suffit, les lignes sont écrites dans le tampon existant (sans copie de la matrice).
+def write_embedding_rows(name, matrix, ids, rows):
+    needed = max(len(matrix), max(ids) + 1)
+    buffer = _ingest_state["buffers"].get(name)
+    if buffer is None or matrix.base is not buffer or needed > len(buffer) or buffer.dtype != matrix.dtype:
+        buffer = np.zeros((max(needed, int(len(matrix) * 1.25) + 1024), matrix.shape[1]), dtype=matrix.dtype)
+        buffer[:len(matrix)] = matrix
+        _ingest_state["buffers"][name] = buffer
+    buffer[ids] = rows
+    return buffer[:needed]
+
+# Fonction pour chaîner l'empreinte des articles en attente avec un nouveau lot d'articles {article_id: embedding}
+def articles_digest(previous, articles):
+    digest = hashlib.sha1(previous.encode())
+    for article_id in sorted(articles):
+        digest.update(np.int64(article_id).tobytes())
+        digest.update(np.asarray(articles[article_id], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+# Fonction pour appliquer des événements ingérés aux données servies. Retourne un nouveau dictionnaire de données :
+# les objets chargés depuis les artefacts ne sont pas modifiés et restent accessibles sous data["base"].
+def apply_ingested_events(data, clicks, articles):
+    if not clicks and not articles:
+        return data
+    data = {**data, "base": data.get("base", data)}
+
+    if articles:
+        ids = sorted(articles)
+        vectors = np.asarray([articles[article_id] for article_id in ids], dtype=np.float32)
+        vectors_norm = normalize_embeddings(vectors)
+        n_articles = len(data["embeddings"])
+        data["embeddings"] = write_embedding_rows("embeddings", data["embeddings"], ids, vectors)
+        # Lignes nulles créées entre l'ancienne fin de la matrice et un article_id plus grand : articles inexistants
+        gap = np.setdiff1d(np.arange(n_articles, len(data["embeddings"])), ids)
+        data["missing_articles"] = np.union1d(np.setdiff1d(data.get("missing_articles", []), ids).astype(np.int64), gap)
+        data["embeddings_norm"] = write_embedding_rows("embeddings_norm", data["embeddings_norm"], ids,
+                                                       quantize_embeddings(vectors_norm, data["embeddings_norm"].dtype))
+        if data.get("ann") is not None:
+            data["ann"] = data["ann"].with_added(ids, vectors_norm)
+
+    if clicks:
+        user_index = data["index"]
+        extra_history = dict(user_index.extra_history)
+        for user_id, article_id in clicks:
+            extra = extra_history.get(user_id, [])
+            if article_id in extra or article_id in user_index.user_history(user_id):
+                continue
+            extra_history[user_id] = extra + [article_id]
+        data["index"] = user_index.with_extra_history(extra_history)
+    return data
+
+# Fonction pour valider et ingérer des clics [{"user_id", "click_article_id"}] et des articles
+# [{"article_id", "embedding"}]. Les articles sont ingérés avant les clics, qui peuvent donc y faire référence.
+def ingest_events(clicks=(), articles=()):
+    data = get_data()
+    accepted_articles, rejected = {}, []
+    n_articles, dim = data["embeddings"].shape
+    for event in articles:
         try:
-            embeddings_2D = np.load(io.BytesIO(embeddings_data), allow_pickle=True)
-            logging.info(f"Embeddings chargés. Type : {type(embeddings_2D)}, Dimensions : {embeddings_2D.shape if hasattr(embeddings_2D, 'shape') else 'N/A'}")
-        except ValueError as e:
-            logging.error(f"Erreur lors du chargement des embeddings : {e}")
+            article_id, embedding = int(event["article_id"]), [float(x) for x in event["embedding"]]
+        except (KeyError, TypeError, ValueError):
+            rejected.append({"event": event, "reason": "article_id ou embedding invalide"})
+            continue
+        if len(embedding) != dim or not 0 <= article_id < n_articles + INGEST_MAX_ARTICLE_GAP:
+            rejected.append({"event": event, "reason": f"embedding de dimension {dim} et article_id < {n_articles + INGEST_MAX_ARTICLE_GAP} attendus"})
+            continue
+        accepted_articles[article_id] = embedding
+
+    known_articles = max(n_articles, max(accepted_articles, default=-1) + 1)
+    accepted_clicks = []
+    for event in clicks:
+        try:
+            user_id, article_id = int(event["user_id"]), int(event["click_article_id"])
+        except (KeyError, TypeError, ValueError):
+            rejected.append({"event": event, "reason": "user_id ou click_article_id invalide"})
+            continue
+        if not 0 <= article_id < known_articles:
+            rejected.append({"event": event, "reason": f"article {article_id} inconnu"})
+            continue
+        accepted_clicks.append((user_id, article_id))
+
+    with _ingest_lock:
+        if accepted_clicks or accepted_articles:
+            _ingest_state["clicks"].extend(accepted_clicks)
+            _ingest_state["articles"].update(accepted_articles)
+            if accepted_articles:
+                _ingest_state["articles_digest"] = articles_digest(_ingest_state["articles_digest"], accepted_articles)
+            data = apply_ingested_events(_data_cache["data"], accepted_clicks, accepted_articles)
+            with _data_cache_lock:
+                _set_cached_data(data, _data_cache["etags"])
+        _ingest_stats["clicks"] += len(accepted_clicks)
+        _ingest_stats["articles"] += len(accepted_articles)
+        _ingest_stats["rejected"] += len(rejected)
+        pending = len(_ingest_state["clicks"]) + len(_ingest_state["articles"])
+        due = pending >= INGEST_COMPACT_MAX_EVENTS or time.monotonic() - _ingest_state["last_compaction"] >= INGEST_COMPACT_INTERVAL
+        if pending and due and not _ingest_state["compacting"] and use_columnar_artifacts():
+            _ingest_state["compacting"] = True
+            threading.Thread(target=compact_ingested_events, daemon=True).start()
+
+    return {
+        "accepted_clicks": len(accepted_clicks),
+        "accepted_articles": len(accepted_articles),
+        "rejected": rejected,
+        "pending_events": pending,
+        "persisted": compaction_supported(),  # False : événements gardés dans la mémoire de ce worker seulement
+        "version": data["version"],
+    }
+
+# Fonction pour savoir si les événements ingérés peuvent être compactés dans des artefacts (sinon ils restent en mémoire)
+def compaction_supported():
+    return use_columnar_artifacts() and not use_user_partitions()
+
+# Fonction pour savoir si la file des événements en attente est pleine (aucune compaction ne peut la vider)
+def ingest_queue_full():
+    with _ingest_lock:
+        pending = len(_ingest_state["clicks"]) + len(_ingest_state["articles"])
+    return not compaction_supported() and pending >= INGEST_MAX_PENDING_EVENTS
 
-        # Charger les autres fichiers CSV et JSON depuis la mémoire
+# Verrou exclusif sur le dossier des artefacts, partagé par les workers qui montent le même dossier (sans fcntl,
+# par exemple sous Windows, seule la vérification de version du manifest protège des écritures concurrentes)
+@contextlib.contextmanager
+def artifacts_lock(directory):
+    with open(os.path.join(directory, ".lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
         try:
-            df_clicks_sample = pd.read_csv(io.BytesIO(df_clicks_sample_data), sep=',', low_memory=False)
-            logging.info("df_clicks_sample chargé avec succès")
-            logging.info(f"df_clicks_sample info: {df_clicks_sample.info()}")  # Ajout du log pour df_clicks_sample
-            logging.info(f"df_clicks_sample shape: {df_clicks_sample.shape}")  # Ajout du log pour la forme de df_clicks_sample
-            logging.info(f"Exemples d'user_id : {df_clicks_sample['user_id'].unique()[:10]}")
-
-            # Vérifier si l'user_id 42 existe dans df_clicks_sample
-            logging.info(f"Existe-t-il un user_id 42 dans df_clicks_sample ? {42 in df_clicks_sample['user_id'].values}")
-            
-            # Afficher les lignes correspondant à user_id 42
-            logging.info(f"Lignes correspondant à user_id 42 dans df_clicks_sample:\n{df_clicks_sample[df_clicks_sample['user_id'] == 42]}")
-            
-        except Exception as e:
-            logging.error(f"Erreur lors du chargement de df_clicks_sample : {e}")
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
 
+# Fonction pour compacter les événements ingérés dans une nouvelle version des artefacts colonnaires.
+# Les recommandations pré-calculées des utilisateurs qui ont de nouveaux clics sont retirées : ils sont
+# servis en ligne jusqu'au prochain recalcul hors ligne.
+# Les compactions sont sérialisées : un appel pendant une compaction en cours attend sa fin, puis compacte les
+# événements arrivés entre-temps. Retourne True si les événements en attente à l'appel ont été compactés.
+def compact_ingested_events():
+    compactions = _ingest_stats["compactions"]
+    with _compaction_lock:
+        with _ingest_lock:
+            _ingest_state["compacting"] = True
         try:
-            df_recommandations = pd.read_json(io.BytesIO(df_recommandations_data))
-            logging.info("df_recommandations chargé avec succès")
-            logging.info(f"df_recommandations info: {df_recommandations.info()}")  # Ajout du log pour df_recommandations
-            logging.info(f"df_recommandations shape: {df_recommandations.shape}")  # Ajout du log pour la forme de df_recommandations
-            logging.info(f"Exemples d'user_id : {df_recommandations['user_id'].unique()[:10]}")
-        except Exception as e:
-            logging.error(f"Erreur lors du chargement de df_recommandations : {e}")
+            # Artefacts réécrits entre-temps par un autre worker : rechargement (les événements en attente sont
+            # ré-appliqués sur la nouvelle version), puis une nouvelle tentative sur cette version
+            if _compact_pending_events() == "stale":
+                revalidate_data_cache()
+                _compact_pending_events()
+        finally:
+            with _ingest_lock:
+                _ingest_state["compacting"] = False
+                _ingest_state["last_compaction"] = time.monotonic()
+        return _ingest_stats["compactions"] > compactions
 
-        logging.info("Fichiers chargés avec succès.")
+# Fonction pour écrire les événements en attente dans les artefacts (appelée sous _compaction_lock).
+# La nouvelle version est construite à partir des artefacts chargés par ce worker : elle n'est écrite que si le
+# manifest désigne toujours cette version (sous artifacts_lock), sinon retourne "stale" sans rien écrire
+def _compact_pending_events():
+    try:
+        if use_user_partitions():
+            logging.warning("Compaction non prise en charge avec les partitions d'utilisateurs : événements gardés en mémoire.")
+            return
+        if not use_columnar_artifacts():
+            logging.warning("Compaction impossible sans artefacts colonnaires (ARTIFACTS_DIR) : événements gardés en mémoire.")
+            return
+        with _ingest_lock:
+            clicks, articles = list(_ingest_state["clicks"]), dict(_ingest_state["articles"])
+            data = _data_cache["data"]
+        if not clicks and not articles:
+            return
+
+        logging.info(f"Compaction de {len(clicks)} clics et {len(articles)} articles ingérés.")
+        base = data.get("base", data)
+        # Types entiers explicites : un DataFrame vide serait de type object, que np.save refuse
+        new_clicks = pd.DataFrame(np.asarray(clicks, dtype=np.int64).reshape(-1, 2), columns=["user_id", "click_article_id"])
+        df_clicks_sample = base["clicks"][["user_id", "click_article_id"]]
+        if clicks:
+            df_clicks_sample = pd.concat([df_clicks_sample, new_clicks], ignore_index=True)
+        df_recommandations = base["recommendations"]
+        df_recommandations = df_recommandations[~df_recommandations["user_id"].isin(new_clicks["user_id"])]
+        ann_index = data["ann"].merged(data["embeddings_norm"]) if data.get("ann") is not None else None
+        with artifacts_lock(ARTIFACTS_DIR):
+            current = read_artifacts_manifest(ARTIFACTS_DIR)["version"]
+            if current != base.get("artifacts_version"):
+                logging.warning(f"Artefacts {current} écrits par un autre processus depuis le chargement de "
+                                f"{base.get('artifacts_version')} : compaction reportée après rechargement.")
+                return "stale"
+            write_columnar_artifacts(ARTIFACTS_DIR, df_clicks_sample, df_recommandations, data["embeddings"], ann_index=ann_index,
+                                     embeddings_precision=data["embeddings_norm"].dtype.name)
+            prune_artifact_versions(ARTIFACTS_DIR)
+        new_data, etags = load_changed_artifacts()
 
+        with _ingest_lock:
+            # Les événements reçus pendant la compaction restent en attente et sont ré-appliqués
+            del _ingest_state["clicks"][:len(clicks)]
+            for article_id, embedding in articles.items():
+                if _ingest_state["articles"].get(article_id) is embedding:
+                    del _ingest_state["articles"][article_id]
+            if not _ingest_state["articles"]:
+                _ingest_state["articles_digest"] = ""
+            new_data = apply_ingested_events(build_derived_data(new_data, etags), _ingest_state["clicks"], _ingest_state["articles"])
+            with _data_cache_lock:
+                _set_cached_data(new_data, etags)
+            _ingest_stats["compactions"] += 1
     except Exception as e:
-        logging.error(f"Erreur lors du chargement des données: {e}")
-        return func.HttpResponse(
-            json.dumps({"error": "Erreur lors du chargement des données"}),
-            status_code=500,
-            mimetype="application/json"
-        )
+        _ingest_stats["compaction_errors"] += 1
+        logging.error(f"Erreur lors de la compaction des événements ingérés : {e}")
+
+# Fonction pour exposer l'état de l'ingestion
+def get_ingest_stats():
+    with _ingest_lock:
+        return {
+            **_ingest_stats,
+            "pending_clicks": len(_ingest_state["clicks"]),
+            "pending_articles": len(_ingest_state["articles"]),
+            "seconds_since_compaction": round(time.monotonic() - _ingest_state["last_compaction"], 1),
+        }
+
+# 4 quinquies. Cache des réponses de /recommend
+# Pour une version des données, la réponse (historique, dernier article, recommandations, scores) ne dépend que
+# de user_id : elle est gardée en mémoire (LRU, durée de vie RESPONSE_CACHE_TTL, taille totale bornée par
+# RESPONSE_CACHE_MAX_BYTES) et servie sans recherche ni calcul. Le cache est vidé dès que la version des données
+# change (artefacts rechargés, articles ingérés). Un clic ingéré n'invalide que la réponse de son utilisateur :
+# chaque réponse est gardée avec l'empreinte des clics ingérés de l'utilisateur (user_history_tag).
+# L'ETag de la réponse est dérivé de la version des données et de cette empreinte : un client qui renvoie
+# If-None-Match reçoit un 304 sans que rien ne soit recalculé, quel que soit le worker qui répond.
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))  # Secondes, 0 pour désactiver le cache
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+_response_cache = OrderedDict()  # user_id -> (réponse, taille en octets, date d'insertion, empreinte des clics ingérés)
+_response_cache_state = {"version": None, "bytes": 0}
+_response_cache_lock = threading.Lock()
+_response_cache_stats = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+# Fonction pour vider le cache si la version des données a changé (appelée sous verrou)
+def _sync_response_cache_version(version):
+    if _response_cache_state["version"] != version:
+        if _response_cache:
+            _response_cache_stats["invalidations"] += 1
+        _response_cache.clear()
+        _response_cache_state.update(version=version, bytes=0)
+
+# Fonction pour calculer l'empreinte des clics ingérés (non compactés) d'un utilisateur ("" s'il n'en a pas)
+def user_history_tag(user_index, user_id):
+    extra = user_index.extra_history.get(user_id)
+    if not extra:
+        return ""
+    return hashlib.sha1(np.asarray(extra, dtype=np.int64).tobytes()).hexdigest()[:8]
+
+# Fonction pour récupérer la réponse en cache d'un utilisateur (None si absente, expirée ou antérieure à ses clics ingérés)
+def get_cached_response(user_id, version, history_tag=""):
+    if RESPONSE_CACHE_TTL <= 0:
+        return None
+    with _response_cache_lock:
+        _sync_response_cache_version(version)
+        entry = _response_cache.get(user_id)
+        if entry is not None and entry[3] != history_tag:
+            del _response_cache[user_id]
+            _response_cache_state["bytes"] -= entry[1]
+            _response_cache_stats["invalidations"] += 1
+            entry = None
+        if entry is not None and time.monotonic() - entry[2] > RESPONSE_CACHE_TTL:
+            del _response_cache[user_id]
+            _response_cache_state["bytes"] -= entry[1]
+            _response_cache_stats["expirations"] += 1
+            entry = None
+        if entry is None:
+            _response_cache_stats["misses"] += 1
+            return None
+        _response_cache.move_to_end(user_id)
+        _response_cache_stats["hits"] += 1
+        return entry[0]
+
+# Fonction pour mettre en cache la réponse d'un utilisateur (les plus anciennes sont évincées au-delà de la taille maximale)
+def put_cached_response(user_id, version, response_data, history_tag=""):
+    if RESPONSE_CACHE_TTL <= 0:
+        return
+    size = len(json.dumps(response_data))
+    with _response_cache_lock:
+        _sync_response_cache_version(version)
+        previous = _response_cache.pop(user_id, None)
+        if previous is not None:
+            _response_cache_state["bytes"] -= previous[1]
+        _response_cache[user_id] = (response_data, size, time.monotonic(), history_tag)
+        _response_cache_state["bytes"] += size
+        while _response_cache_state["bytes"] > RESPONSE_CACHE_MAX_BYTES and _response_cache:
+            _, (_, evicted_size, _, _) = _response_cache.popitem(last=False)
+            _response_cache_state["bytes"] -= evicted_size
+            _response_cache_stats["evictions"] += 1
+
+# Fonction pour construire l'ETag d'une réponse de /recommend. Il est faible (W/) : graph_status peut évoluer
+# (pending -> ready) sans que les recommandations changent
+def build_response_etag(user_id, version, graph_mode, history_tag=""):
+    return f'W/"{version}-{user_id}{"." + history_tag if history_tag else ""}-{graph_mode}"'
+
+# Fonction pour savoir si l'en-tête If-None-Match d'une requête correspond à l'ETag courant
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    # Comparaison faible (RFC 9110) : le préfixe W/ est ignoré
+    return "*" in candidates or etag.removeprefix("W/") in (candidate.removeprefix("W/") for candidate in candidates)
+
+# Fonction pour compter une réponse 304
+def record_not_modified():
+    with _response_cache_lock:
+        _response_cache_stats["not_modified"] += 1
 
-    if not df_clicks_sample_data or not df_recommandations_data or not embeddings_data:
-        logging.error("Erreur : Un ou plusieurs fichiers n'ont pas été téléchargés correctement")
-    else :
-        logging.info("Données téléchargées. Chargement des fichiers...")
+# Fonction pour exposer l'état et les compteurs du cache des réponses
+def get_response_cache_stats():
+    with _response_cache_lock:
+        lookups = _response_cache_stats["hits"] + _response_cache_stats["misses"]
+        return {
+            **_response_cache_stats,
+            "hit_ratio": round(_response_cache_stats["hits"] / lookups, 4) if lookups else None,
+            "entries": len(_response_cache),
+            "bytes": _response_cache_state["bytes"],
+            "max_bytes": RESPONSE_CACHE_MAX_BYTES,
+            "ttl_seconds": RESPONSE_CACHE_TTL,
+            "version": _response_cache_state["version"],
+        }
+
+# 4 sexies. Liste des utilisateurs (route /users)
+# La liste triée des user_id et la taille de leur historique est calculée une fois par version des données
+# (build_derived_data, ou pré-calculée dans les artefacts partitionnés) : une page est une simple tranche.
+# Les utilisateurs créés par des clics ingérés n'y apparaissent qu'après la compaction suivante.
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "50"))
+USERS_PAGE_MAX = 1000
+
+# Fonction pour lire offset et limit d'une requête /users. Lève ValueError si un paramètre est invalide
+def parse_users_page(req):
+    try:
+        offset = int(req.params.get("offset", 0))
+        limit = int(req.params.get("limit", USERS_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError("Paramètres offset et limit entiers attendus.")
+    if offset < 0 or not 0 < limit <= USERS_PAGE_MAX:
+        raise ValueError(f"offset doit être positif et limit compris entre 1 et {USERS_PAGE_MAX}.")
+    return offset, limit
+
+# Fonction pour construire une page de la liste des utilisateurs
+def get_users_page(data, offset, limit):
+    user_ids, history_counts = data["users"]
+    page_ids = np.asarray(user_ids[offset:offset + limit]).tolist()
+    page_counts = np.asarray(history_counts[offset:offset + limit]).tolist()
+    # Les clics ingérés allongent l'historique des utilisateurs déjà connus
+    user_index = data["index"]
+    users = [{"user_id": user_id,
+              "history_count": len(user_index.user_history(user_id)) if user_id in user_index.extra_history else count}
+             for user_id, count in zip(page_ids, page_counts)]
+    total = len(user_ids)
+    return {
+        "users": users,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "next_offset": offset + limit if offset + limit < total else None,
+    }
 
-    return df_clicks_sample, df_recommandations, embeddings_2D
 
 # 5. Fonction main avec décorateur (Fonction principale de l'Azure Function)
 @app.route(route="recommend")
 @app.function_name(name="recommend_articles")
-def main(req: func.HttpRequest) -> func.HttpResponse:
+@with_server_timing("recommend")
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Requête reçue pour récupérer des recommandations utilisateur.")
 
-    # Récupérer la chaîne de connexion depuis les variables d'environnement
-    connection_string = os.getenv("AzureWebJobsStorage")
-    if connection_string is None:
-        raise ValueError("La chaîne de connexion est manquante ou incorrecte")
-    # Initialiser le client BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-
     try:
         # Récupérer le paramètre 'user_id' de la requête
         user_id_str = req.params.get('user_id')
 
-        if user_id_str is None:
-            return func.HttpResponse("Paramètre 'user_id' manquant.", status_code=400)
-
         if user_id_str is None:
             return func.HttpResponse("Paramètre 'user_id' manquant.", status_code=400)
 
         try:
             user_id = int(user_id_str)  # Conversion explicite
-            logging.info(f"User ID reçu : {user_id} (type: {type(user_id)})")
+            logging.info(f"User ID reçu : {user_id}")
         except (TypeError, ValueError):
             logging.warning(f"user_id invalide : {user_id_str}")
             return func.HttpResponse(
@@ -168,33 +1477,68 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 mimetype="application/json"
             )
 
-        # Charger les données nécessaires depuis le Blob Storage
-        df_clicks_sample, df_recommandations, embeddings_2D = load_data()
-        
-        # Appeler les fonctions pour générer les résultats
-        user_history, last_article = get_user_history(user_id, df_clicks_sample)
-        if not user_history:
+        graph_mode = req.params.get('graph', 'defer')
+        if graph_mode not in GRAPH_MODES:
             return func.HttpResponse(
-                json.dumps({"message": f"Aucun historique trouvé pour l'utilisateur {user_id}."}),
-                status_code=404,
+                json.dumps({'message': f"Paramètre graph invalide : {graph_mode} (valeurs possibles : {', '.join(GRAPH_MODES)})"}),
+                status_code=400,
                 mimetype="application/json"
             )
 
-        reco_ids, last_article, scores = get_recommendations(user_id, df_clicks_sample, df_recommandations)
-        
-        # Générer un graphique des embeddings
-        graph_buffer = plot_user_embeddings(user_id, df_clicks_sample, df_recommandations, embeddings_2D)
-        
-        # Sauvegarder le graphique dans le Blob Storage
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AzureWebJobsStorage"))
-        graph_blob_client = blob_service_client.get_blob_client(container=CONTAINER_NAME, blob=f"{user_id}_graph.png")
-        graph_blob_client.upload_blob(graph_buffer.read(), overwrite=True)
-        
-        # Définir l'URL de base du graph sans le SAS Token
-        base_url = "https://dashboardsaea6.blob.core.windows.net/graphs"
-        # Extraire la partie SAS Token de l'URL
-        sas_token = GRAPHS_SAS_URL.split('?')[1]
-        
+        # Récupérer les données depuis le cache du processus (téléchargées depuis le Blob Storage au premier appel).
+        # Le premier chargement (plusieurs secondes) est fait dans un thread pour ne pas bloquer la boucle d'événements
+        data = get_data() if _data_cache["data"] is not None else await asyncio.to_thread(get_data)
+        user_index, embeddings_2D, version = data["index"], data["embeddings"], data["version"]
+
+        # Le client a déjà la réponse pour cette version des données et ces clics ingérés : 304 sans aucun calcul
+        history_tag = user_history_tag(user_index, user_id)
+        headers = {"ETag": build_response_etag(user_id, version, graph_mode, history_tag), "Cache-Control": "private, no-cache"}
+        if etag_matches(req.headers.get("If-None-Match"), headers["ETag"]):
+            record_not_modified()
+            return func.HttpResponse(status_code=304, headers=headers)
+
+        cached_response = get_cached_response(user_id, version, history_tag)
+        if cached_response is not None:
+            user_history, last_article = cached_response["user_history"], cached_response["last_article"]
+            reco_ids, scores = cached_response["recommendations"], cached_response["scores"]
+        else:
+            # Appeler les fonctions pour générer les résultats (une seule recherche dans l'index par requête)
+            with timed_stage("lookup"):
+                user_history, last_article = get_user_history(user_id, user_index)
+            if not user_history:
+                return func.HttpResponse(
+                    json.dumps({"message": f"Aucun historique trouvé pour l'utilisateur {user_id}."}),
+                    status_code=404,
+                    mimetype="application/json"
+                )
+
+            try:
+                with timed_stage("scoring"):
+                    reco_ids, last_article, scores = get_recommendations(user_id, user_index, user_history=user_history, last_article=last_article,
+                                                                         embeddings_norm=data["embeddings_norm"], ann_index=data.get("ann"),
+                                                                         missing_articles=data.get("missing_articles"),
+                                                                         embeddings=data["embeddings"])
+            except ValueError:
+                # Ni recommandations pré-calculées ni article recommandable en ligne (historique couvrant tout le catalogue)
+                return func.HttpResponse(
+                    json.dumps({"message": f"Aucune recommandation trouvée pour l'utilisateur {user_id}."}),
+                    status_code=404,
+                    mimetype="application/json"
+                )
+            put_cached_response(user_id, version, {"user_id": user_id, "user_history": user_history, "last_article": last_article,
+                                                   "recommendations": reco_ids, "scores": scores}, history_tag)
+
+        # Générer le graphique des embeddings et le sauvegarder dans le Blob Storage (sauf s'il est déjà à jour).
+        # graph=defer (défaut) : la réponse part tout de suite, le rendu et l'upload sont faits en arrière-plan
+        # (état consultable sur /recommend/graph) ; graph=sync : la réponse attend le graphique ; graph=none : pas de graphique
+        graph_args = (user_id, version, user_history, last_article, reco_ids, scores, embeddings_2D)
+        graph_status = None
+        if graph_mode == "sync":
+            await asyncio.to_thread(ensure_user_graph, *graph_args)
+            graph_status = "ready"
+        elif graph_mode == "defer":
+            graph_status = submit_user_graph(*graph_args)
+
         # Construire la réponse JSON
         response_data = {
             "user_id": user_id,
@@ -202,86 +1546,551 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             "last_article": last_article,
             "recommendations": reco_ids,
             "scores": scores,
-            "graph_url": f"{base_url}/{user_id}_graph.png?{sas_token}"
+            "graph_url": build_graph_url(user_id) if graph_status in ("ready", "pending") else None,
+            "graph_status": graph_status
         }
         
-        return func.HttpResponse(json.dumps(response_data), mimetype="application/json", status_code=200)
+        return func.HttpResponse(json.dumps(response_data), mimetype="application/json", status_code=200, headers=headers)
     
     except Exception as e:
         logging.error(f"Erreur inattendue : {e}")
         return func.HttpResponse("Erreur interne du serveur.", status_code=500)
 
+# Route pour savoir si le graphique d'un utilisateur (demandé avec graph=defer) est disponible.
+# Codes : 200 prêt, 202 en cours, 404 aucun graphique connu, 500 échec du rendu ou de l'upload
+@app.route(route="recommend/graph")
+@app.function_name(name="recommend_graph_status")
+def graph_status(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        user_id = int(req.params.get('user_id'))
+    except (TypeError, ValueError):
+        return func.HttpResponse(
+            json.dumps({'message': f"user_id invalide : {req.params.get('user_id')}"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    status, error = get_graph_status(user_id)
+    response_data = {"user_id": user_id, "status": status, "graph_url": build_graph_url(user_id) if status in ("ready", "pending") else None}
+    if error is not None:
+        response_data["message"] = error
+    status_code = {"ready": 200, "pending": 202, "missing": 404, "error": 500}[status]
+    return func.HttpResponse(json.dumps(response_data), mimetype="application/json", status_code=status_code)
+
+# Route de recommandation pour un lot d'utilisateurs (tâches newsletter / notifications push)
+# Corps JSON {"user_ids": [...], "top_n": 5, "graph": false} ou NDJSON (une ligne {"user_id": ...} ou un id par ligne).
+# La réponse est en NDJSON : une ligne par utilisateur, dans l'ordre reçu, avec son propre code "status".
+# Elle est construite entièrement en mémoire avant d'être envoyée (pas de streaming : le modèle HTTP de
+# azure.functions n'envoie qu'un corps complet), d'où la limite MAX_BATCH_SIZE. top_n : entre 1 et MAX_TOP_N.
+# Les graphiques ne sont générés que si graph=true (paramètre de requête ou champ du corps JSON), en arrière-plan :
+# chaque ligne porte graph_status ("ready", "pending" ou "skipped", voir /recommend/graph) et graph_url.
+@app.route(route="recommend/batch", methods=["POST"])
+@app.function_name(name="recommend_articles_batch")
+@with_server_timing("recommend_batch")
+def recommend_batch(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        raw_user_ids, options = parse_batch_request(req)
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"message": str(e)}), status_code=400, mimetype="application/json")
+    if len(raw_user_ids) > MAX_BATCH_SIZE:
+        return func.HttpResponse(
+            json.dumps({"message": f"Lot trop grand : {len(raw_user_ids)} utilisateurs (maximum {MAX_BATCH_SIZE})."}),
+            status_code=413,
+            mimetype="application/json"
+        )
+    logging.info(f"Requête de recommandations par lot pour {len(raw_user_ids)} utilisateurs.")
+
+    try:
+        data = get_data()
+        lines = iter_batch_recommendations(raw_user_ids, data, top_n=options["top_n"], with_graph=options["graph"])
+        # Réponse mise en mémoire tampon : les lignes sont produites une à une, puis envoyées en un seul corps
+        body = "".join(json.dumps(line) + "\n" for line in lines)
+        return func.HttpResponse(body, mimetype="application/x-ndjson", status_code=200)
+    except Exception as e:
+        logging.error(f"Erreur inattendue : {e}")
+        return func.HttpResponse("Erreur interne du serveur.", status_code=500)
+
+# Route d'ingestion de nouveaux clics et de nouveaux articles
+# Corps JSON {"clicks": [{"user_id": ..., "click_article_id": ...}], "articles": [{"article_id": ..., "embedding": [...]}]}
+# compact=true force la compaction immédiate des événements en attente dans les artefacts.
+@app.route(route="ingest", methods=["POST"])
+@app.function_name(name="ingest_events")
+@with_server_timing("ingest")
+def ingest(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        payload = req.get_json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict) or not isinstance(payload.get("clicks", []), list) or not isinstance(payload.get("articles", []), list):
+        return func.HttpResponse(
+            json.dumps({"message": "Le corps doit être un objet JSON avec des listes 'clicks' et/ou 'articles'."}),
+            status_code=400,
+            mimetype="application/json"
+        )
+
+    if ingest_queue_full():
+        return func.HttpResponse(
+            json.dumps({"message": f"{INGEST_MAX_PENDING_EVENTS} événements en attente sans compaction possible (ARTIFACTS_DIR requis)."}),
+            status_code=503,
+            mimetype="application/json"
+        )
+
+    try:
+        result = ingest_events(payload.get("clicks", []), payload.get("articles", []))
+        if req.params.get("compact", "false").lower() == "true":
+            result["compacted"] = compact_ingested_events()
+        return func.HttpResponse(json.dumps(result), mimetype="application/json", status_code=200)
+    except Exception as e:
+        logging.error(f"Erreur inattendue : {e}")
+        return func.HttpResponse("Erreur interne du serveur.", status_code=500)
+
+# Route de la liste paginée des utilisateurs, triés par user_id : ?offset=0&limit=50.
+# Comme /recommend, la réponse porte un ETag dérivé de la version des données (304 si inchangée)
+@app.route(route="users")
+@app.function_name(name="list_users")
+@with_server_timing("users")
+def list_users(req: func.HttpRequest) -> func.HttpResponse:
+    try:
+        offset, limit = parse_users_page(req)
+    except ValueError as e:
+        return func.HttpResponse(json.dumps({"message": str(e)}), status_code=400, mimetype="application/json")
+
+    try:
+        data = get_data()
+        headers = {"ETag": f'W/"{data["version"]}-users-{offset}-{limit}"', "Cache-Control": "private, no-cache"}
+        if etag_matches(req.headers.get("If-None-Match"), headers["ETag"]):
+            record_not_modified()
+            return func.HttpResponse(status_code=304, headers=headers)
+        return func.HttpResponse(json.dumps(get_users_page(data, offset, limit)), mimetype="application/json",
+                                 status_code=200, headers=headers)
+    except Exception as e:
+        logging.error(f"Erreur inattendue : {e}")
+        return func.HttpResponse("Erreur interne du serveur.", status_code=500)
+
+# Route pour consulter l'état du cache de données (compteurs hits / misses / reloads)
+@app.route(route="cache/stats")
+@app.function_name(name="data_cache_stats")
+def cache_stats(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(get_data_cache_stats()), mimetype="application/json", status_code=200)
+
+# Route pour consulter les histogrammes de durée par étape et par route (depuis le démarrage du processus)
+@app.route(route="metrics")
+@app.function_name(name="stage_metrics")
+def metrics(req: func.HttpRequest) -> func.HttpResponse:
+    return func.HttpResponse(json.dumps(get_metrics()), mimetype="application/json", status_code=200)
+
 # 6. Autres fonctions
 
 # Fonction pour récupérer l'historique d'un utilisateur et l'id du dernier article consulté
-def get_user_history(user_id, df_clicks_sample):
+def get_user_history(user_id, user_index):
     logging.info(f"Recherche de l'historique pour l'utilisateur {user_id}.")
 
-    # Ajout de debug pour les types
-    logging.info(f"Type de `user_id` reçu : {type(user_id)}")
-    logging.info(f"Type de `df_clicks_sample['user_id']` : {df_clicks_sample['user_id'].dtype}")
-    
-    if user_id not in df_clicks_sample['user_id'].unique():
+    user_history = user_index.user_history(user_id).tolist()
+    if not user_history:
         logging.warning(f"Utilisateur {user_id} non trouvé dans df_clicks_sample.")
         return [], None  # Retourne une liste vide et None
-        
-    user_clicks = df_clicks_sample[df_clicks_sample['user_id'] == user_id]
-    if user_clicks.empty:
-        logging.warning(f"L'utilisateur {user_id} n'a pas d'historique de clics.")
-        return [], None
-    
-    user_history = user_clicks['click_article_id'].unique().tolist()
-    last_article = user_history[-1] if user_history else None
 
-    logging.info(f"Historique trouvé pour l'utilisateur {user_id}: {user_history}")
-    
+    last_article = user_history[-1]
+
+    logging.info(f"Historique trouvé pour l'utilisateur {user_id} : {len(user_history)} articles")
+    if debug_enabled():
+        logging.debug(f"Historique de l'utilisateur {user_id}: {user_history}")
+
     return user_history, last_article
 
+# Fonction pour normaliser les embeddings (norme L2 = 1) : le produit scalaire devient une similarité cosinus
+def normalize_embeddings(embeddings_2D):
+    matrix = np.asarray(embeddings_2D, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+# Fonction pour construire le profil d'un utilisateur : moyenne des embeddings normalisés de son historique
+def build_user_profile(user_history, embeddings_norm):
+    history = np.asarray(user_history, dtype=np.int64)
+    history = history[(history >= 0) & (history < len(embeddings_norm))]  # Articles sans embedding ignorés
+    if len(history) == 0:
+        return None
+    profile = embedding_rows(embeddings_norm, history).mean(axis=0)
+    norm = np.linalg.norm(profile)
+    return profile / norm if norm > 0 else profile
+
+# Fonction pour sélectionner les top_n meilleurs scores (argpartition puis tri des seuls top_n)
+def select_top_k(scores, top_n):
+    k = min(top_n, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+# Fonction pour re-classer des candidats avec des scores exacts : profil et lignes recalculés en float32 depuis les
+# embeddings d'origine (les scores des embeddings quantifiés peuvent dépasser 1 ou être ex aequo). Retourne (ids, scores)
+def rerank_exact(candidates, user_history, embeddings, top_n):
+    history = np.asarray(user_history, dtype=np.int64)
+    history = history[(history >= 0) & (history < len(embeddings))]
+    profile = normalize_embeddings(embeddings[history]).mean(axis=0)
+    norm = np.linalg.norm(profile)
+    profile = profile / norm if norm > 0 else profile
+    scores = np.clip(normalize_embeddings(embeddings[candidates]) @ profile, -1.0, 1.0)
+    order = np.argsort(-scores, kind="stable")[:top_n]
+    return candidates[order].tolist(), scores[order].astype(float).tolist()
+
+# Fonction de recommandation en ligne : similarité cosinus entre le profil utilisateur et tous les articles,
+# en excluant les articles déjà consultés et les articles sans embedding. Avec un index ANN, seuls les groupes IVF les plus proches sont parcourus.
+# Si les embeddings normalisés sont quantifiés (float16, int8) et que les embeddings d'origine sont fournis,
+# les EXACT_RERANK_FACTOR * top_n meilleurs candidats sont re-classés avec des scores exacts.
+def score_user_online(user_history, embeddings_norm, top_n=5, ann_index=None, nprobe=ANN_NPROBE, missing_articles=None,
+                      embeddings=None):
+    profile = build_user_profile(user_history, embeddings_norm)
+    if profile is None:
+        return [], []
+    rerank = embeddings is not None and embeddings_norm.dtype != np.float32
+    k = EXACT_RERANK_FACTOR * top_n if rerank else top_n
+    excluded = np.asarray(user_history, dtype=np.int64)
+    if missing_articles is not None and len(missing_articles):
+        excluded = np.concatenate([excluded, missing_articles])
+    if ann_index is not None:
+        top, scores = ann_index.search(profile, embeddings_norm, k, nprobe=nprobe, exclude=excluded)
+    else:
+        scores = embedding_dot(embeddings_norm, profile)
+        scores[excluded[(excluded >= 0) & (excluded < len(scores))]] = -np.inf
+        top = select_top_k(scores, k)
+        scores = scores[top]
+    if rerank and len(top):
+        return rerank_exact(top, user_history, embeddings, top_n)
+    return top.tolist(), scores.astype(float).tolist()
+
 # Fonction de recommandation basée sur le contenu
-def get_recommendations(user_id, df_clicks_sample, df_recommandations, top_n=5):
+# L'historique peut être passé par l'appelant pour éviter une seconde recherche dans l'index.
+# Les recommandations pré-calculées sont un chemin rapide : à défaut (nouvel utilisateur, recommandations
+# pas encore recalculées) elles sont calculées en ligne à partir des embeddings normalisés.
+def get_recommendations(user_id, user_index, top_n=5, user_history=None, last_article=None, embeddings_norm=None,
+                        ann_index=None, missing_articles=None, embeddings=None):
     logging.info(f"Récupération des recommandations pour l'utilisateur {user_id}.")
 
-    user_history, last_article = get_user_history(user_id, df_clicks_sample)
+    if user_history is None:
+        user_history, last_article = get_user_history(user_id, user_index)
     if not user_history:
         return [], None, []
-    logging.info(f"Historique utilisateur {user_id}: {user_history}")
-    
+
     # Récupération des recommandations pré-calculées
-    user_recommendations = df_recommandations[df_recommandations['user_id'] == user_id]
-    if user_recommendations.empty:
+    reco_ids, scores = user_index.user_recommendations(user_id, top_n)
+    reco_ids, scores = reco_ids.tolist(), scores.tolist()
+
+    if not reco_ids and embeddings_norm is not None:
+        logging.info(f"Pas de recommandations pré-calculées pour l'utilisateur {user_id}, calcul en ligne.")
+        reco_ids, scores = score_user_online(user_history, embeddings_norm, top_n, ann_index=ann_index,
+                                             missing_articles=missing_articles, embeddings=embeddings)
+
+    if not reco_ids:
         logging.error(f"Aucune recommandation trouvée pour l'utilisateur {user_id}.")
         raise ValueError("Aucune recommandation trouvée pour cet utilisateur.")
-    
-    reco_ids = user_recommendations['article_id'].tolist()[:top_n]
-    scores = user_recommendations['similarity_score'].tolist()[:top_n]
 
-    logging.info(f"Recommandations générées pour l'utilisateur {user_id}: {reco_ids} avec scores {scores}")
-    
+    if debug_enabled():
+        logging.debug(f"Recommandations générées pour l'utilisateur {user_id}: {reco_ids} avec scores {scores}")
+
     return reco_ids, last_article, scores
 
+# Fonction de recommandation en ligne pour plusieurs utilisateurs : les profils sont regroupés par blocs
+# et scorés avec un seul produit matriciel par bloc (block_size x n_articles scores en mémoire au maximum)
+def score_users_online(user_histories, embeddings_norm, top_n=5, ann_index=None, block_size=32, missing_articles=None,
+                       embeddings=None):
+    if ann_index is not None:
+        return [score_user_online(history, embeddings_norm, top_n, ann_index=ann_index, missing_articles=missing_articles,
+                                  embeddings=embeddings)
+                for history in user_histories]
+    rerank = embeddings is not None and embeddings_norm.dtype != np.float32
+
+    results = [([], [])] * len(user_histories)
+    for start in range(0, len(user_histories), block_size):
+        block = user_histories[start:start + block_size]
+        profiles = [build_user_profile(history, embeddings_norm) for history in block]
+        rows = [i for i, profile in enumerate(profiles) if profile is not None]
+        if not rows:
+            continue
+        block_profiles = np.stack([profiles[i] for i in rows])
+        if embeddings_norm.dtype == np.float32:
+            scores = block_profiles @ embeddings_norm.T
+        else:
+            scores = np.ascontiguousarray(embedding_dot(embeddings_norm, block_profiles.T).T)
+        # Exclure les articles sans embedding, puis les articles déjà consultés de chaque ligne
+        if missing_articles is not None and len(missing_articles):
+            scores[:, missing_articles[missing_articles < scores.shape[1]]] = -np.inf
+        for row, i in enumerate(rows):
+            history = np.asarray(block[i], dtype=np.int64)
+            scores[row, history[(history >= 0) & (history < scores.shape[1])]] = -np.inf
+        k = min(EXACT_RERANK_FACTOR * top_n if rerank else top_n, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        top, top_scores = np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+        for row, i in enumerate(rows):
+            finite = np.isfinite(top_scores[row])
+            if rerank and finite.any():
+                results[start + i] = rerank_exact(top[row][finite], block[i], embeddings, top_n)
+            else:
+                results[start + i] = (top[row][finite].tolist(), top_scores[row][finite].astype(float).tolist())
+    return results
+
+# Fonction pour lire top_n (entier entre 1 et MAX_TOP_N). Lève ValueError sinon
+def parse_top_n(value):
+    try:
+        top_n = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"top_n invalide : {value}")
+    if not 1 <= top_n <= MAX_TOP_N:
+        raise ValueError(f"top_n doit être compris entre 1 et {MAX_TOP_N}.")
+    return top_n
+
+# Fonction pour lire le corps d'une requête de recommandations par lot. Retourne (ids bruts, options).
+# Une ligne NDJSON illisible est gardée telle quelle comme id brut (statut 400 pour cette ligne seulement).
+# Lève ValueError si le corps ou une option est invalide
+def parse_batch_request(req):
+    options = {"top_n": 5, "graph": req.params.get("graph", "false").lower() == "true"}
+    if "top_n" in req.params:
+        options["top_n"] = parse_top_n(req.params["top_n"])
+
+    if "ndjson" in req.headers.get("Content-Type", ""):
+        user_ids = []
+        for line in req.get_body().decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            try:
+                value = json.loads(line)
+            except ValueError:
+                user_ids.append(line)
+                continue
+            user_ids.append(value.get("user_id") if isinstance(value, dict) else value)
+        return user_ids, options
+
+    try:
+        payload = req.get_json()
+    except ValueError:
+        raise ValueError("Corps JSON invalide.")
+    if not isinstance(payload, dict) or not isinstance(payload.get("user_ids"), list):
+        raise ValueError("Le corps doit contenir une liste 'user_ids'.")
+    options["top_n"] = parse_top_n(payload.get("top_n", options["top_n"]))
+    options["graph"] = bool(payload.get("graph", options["graph"]))
+    return payload["user_ids"], options
+
+# Fonction de recommandation pour un lot d'utilisateurs en une passe vectorisée sur les données chargées.
+# Génère un dictionnaire par utilisateur, dans l'ordre reçu, avec un code de statut HTTP par utilisateur.
+def iter_batch_recommendations(raw_user_ids, data, top_n=5, with_graph=False):
+    user_index = data["index"]
+
+    user_ids = np.full(len(raw_user_ids), -1, dtype=np.int64)
+    valid = np.zeros(len(raw_user_ids), dtype=bool)
+    for i, raw_user_id in enumerate(raw_user_ids):
+        try:
+            user_ids[i] = int(raw_user_id)
+            valid[i] = True
+        except (TypeError, ValueError):
+            pass
+
+    # Recherche des utilisateurs dans l'index, en un seul appel par partition (-1 si absent) : avec des
+    # partitions d'utilisateurs, seules celles du lot sont chargées, chacune une seule fois
+    partition_ids = np.where(valid, user_index.partition_ids(user_ids), -1)
+    history_pos = np.full(len(user_ids), -1, dtype=np.int64)
+    reco_pos = np.full(len(user_ids), -1, dtype=np.int64)
+    partitions = {}
+    for partition_id in np.unique(partition_ids[valid]).tolist():
+        partition = partitions[partition_id] = user_index.partition(partition_id)
+        members = np.flatnonzero(partition_ids == partition_id)
+        history_pos[members] = partition.history.keys.get_indexer(user_ids[members])
+        reco_pos[members] = partition.recommendations.keys.get_indexer(user_ids[members])
+    # Utilisateurs avec des clics ingérés : historique complété, recommandations pré-calculées ignorées
+    has_extra = valid & np.isin(user_ids, list(user_index.extra_history)) if user_index.extra_history else np.zeros(len(user_ids), dtype=bool)
+    reco_pos[has_extra] = -1
+    known = (history_pos >= 0) | has_extra
+
+    def history_of(i):
+        if has_extra[i]:
+            return user_index.user_history(int(user_ids[i]))
+        history_table, pos = partitions[partition_ids[i]].history, history_pos[i]
+        return history_table.columns["article_id"][history_table.offsets[pos]:history_table.offsets[pos + 1]]
+
+    # Les utilisateurs sans recommandations pré-calculées sont scorés ensemble
+    online = np.flatnonzero(known & (reco_pos < 0))
+    with timed_stage("scoring"):
+        online_results = dict(zip(online.tolist(), score_users_online(
+            [history_of(i) for i in online], data["embeddings_norm"], top_n, ann_index=data.get("ann"),
+            missing_articles=data.get("missing_articles"), embeddings=data["embeddings"])))
+
+    for i, raw_user_id in enumerate(raw_user_ids):
+        if not valid[i]:
+            yield {"user_id": raw_user_id, "status": 400, "message": f"user_id invalide : {raw_user_id}"}
+            continue
+        user_id = int(user_ids[i])
+        if not known[i]:
+            yield {"user_id": user_id, "status": 404, "message": f"Aucun historique trouvé pour l'utilisateur {user_id}."}
+            continue
+
+        user_history = history_of(i).tolist()
+        if reco_pos[i] >= 0:
+            reco_table = partitions[partition_ids[i]].recommendations
+            start = reco_table.offsets[reco_pos[i]]
+            end = min(reco_table.offsets[reco_pos[i] + 1], start + top_n)
+            reco_ids = reco_table.columns["article_id"][start:end].tolist()
+            scores = reco_table.columns["similarity_score"][start:end].tolist()
+        else:
+            reco_ids, scores = online_results[i]
+        if not reco_ids:
+            yield {"user_id": user_id, "status": 404, "message": f"Aucune recommandation trouvée pour l'utilisateur {user_id}."}
+            continue
+
+        line = {
+            "user_id": user_id,
+            "status": 200,
+            "user_history": user_history,
+            "last_article": user_history[-1],
+            "recommendations": reco_ids,
+            "scores": scores,
+        }
+        if with_graph:
+            # Rendu en arrière-plan (comme graph=defer sur /recommend) : le lot n'attend pas les graphiques
+            line["graph_status"] = submit_user_graph(user_id, data["version"], user_history, user_history[-1], reco_ids, scores, data["embeddings"])
+            line["graph_url"] = build_graph_url(user_id) if line["graph_status"] in ("ready", "pending") else None
+        yield line
+
+# Fonction pour construire l'URL du graphique d'un utilisateur (avec SAS Token sur Azure, voir storage.py)
+def build_graph_url(user_id):
+    return get_storage().graph_url(CONTAINER_NAME, f"{user_id}_graph.png")
+
+# Fonction pour sauvegarder le graphique d'un utilisateur dans le Blob Storage
+def upload_graph(user_id, graph_buffer):
+    get_storage().upload(CONTAINER_NAME, f"{user_id}_graph.png", graph_buffer.read())
+
+# Cache des graphiques : user_id -> clé (version des données, recommandations) du dernier graphique envoyé dans
+# le Blob Storage. Seule la clé est gardée : elle suffit pour savoir si le graphique en ligne est à jour
+_graph_cache = OrderedDict()
+_graph_cache_lock = threading.Lock()
+_graph_executor = ThreadPoolExecutor(max_workers=GRAPH_WORKERS, thread_name_prefix="graph")
+# Rendus différés : user_id -> (clé, Future) du dernier rendu demandé, et nombre de rendus en attente
+_graph_jobs = OrderedDict()
+_graph_pending = {"count": 0}
+
+# Fond de la vue globale (nuage gris de tous les articles), rendu une seule fois par matrice d'embeddings
+_graph_background = {"embeddings": None, "image": None, "extent": None}
+_graph_background_lock = threading.Lock()
+
+# Fonction pour rendre le nuage de tous les articles en image RGBA (rendu une fois, puis réutilisé)
+def get_graph_background(embeddings_2D, width_px=1000, height_px=800, dpi=100):
+    with _graph_background_lock:
+        if _graph_background["embeddings"] is embeddings_2D:
+            return _graph_background["image"], _graph_background["extent"]
+
+        logging.info("Rendu du fond de la vue globale des embeddings.")
+        x, y = embeddings_2D[:, 0], embeddings_2D[:, 1]
+        # Mêmes marges (5 %) que l'autoscale de Matplotlib
+        pad_x, pad_y = 0.05 * (x.max() - x.min()), 0.05 * (y.max() - y.min())
+        extent = (float(x.min() - pad_x), float(x.max() + pad_x), float(y.min() - pad_y), float(y.max() + pad_y))
+
+        fig = Figure(figsize=(width_px / dpi, height_px / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.scatter(x, y, s=5, color='gray', alpha=0.3)
+        ax.set_xlim(extent[0], extent[1])
+        ax.set_ylim(extent[2], extent[3])
+        canvas.draw()
+        image = np.asarray(canvas.buffer_rgba()).copy()
+
+        _graph_background.update(embeddings=embeddings_2D, image=image, extent=extent)
+        return image, extent
+
+# Fonction pour s'assurer que le graphique d'un utilisateur est rendu et envoyé dans le Blob Storage.
+# Un graphique déjà à jour pour (version des données, recommandations) n'est ni re-rendu ni ré-envoyé.
+def ensure_user_graph(user_id, version, user_history, last_article, reco_ids, scores, embeddings_2D):
+    key = (version, tuple(reco_ids))
+    with _graph_cache_lock:
+        if _graph_cache.get(user_id) == key:
+            _graph_cache.move_to_end(user_id)
+            return
+
+    with timed_stage("render"):
+        graph_buffer = plot_user_embeddings(user_id, user_history, last_article, reco_ids, scores, embeddings_2D)
+    with timed_stage("upload"):
+        upload_graph(user_id, graph_buffer)
+
+    with _graph_cache_lock:
+        _graph_cache[user_id] = key
+        _graph_cache.move_to_end(user_id)
+        while len(_graph_cache) > GRAPH_CACHE_SIZE:
+            _graph_cache.popitem(last=False)
+
+# Fonction pour lancer le rendu et l'upload d'un graphique en arrière-plan (graph=defer).
+# Retourne l'état du graphique : "ready" (déjà à jour), "pending" (en cours) ou "skipped" (trop de rendus en attente)
+def submit_user_graph(user_id, version, user_history, last_article, reco_ids, scores, embeddings_2D):
+    key = (version, tuple(reco_ids))
+    with _graph_cache_lock:
+        if _graph_cache.get(user_id) == key:
+            return "ready"
+        job = _graph_jobs.get(user_id)
+        if job is not None and job[0] == key and not job[1].done():
+            return "pending"
+        if _graph_pending["count"] >= GRAPH_MAX_PENDING:
+            logging.warning(f"{_graph_pending['count']} graphiques en attente : pas de graphique pour l'utilisateur {user_id}.")
+            return "skipped"
+        _graph_pending["count"] += 1
+
+    future = _graph_executor.submit(ensure_user_graph, user_id, version, user_history, last_article, reco_ids, scores, embeddings_2D)
+    with _graph_cache_lock:
+        _graph_jobs[user_id] = (key, future)
+        _graph_jobs.move_to_end(user_id)
+        while len(_graph_jobs) > GRAPH_CACHE_SIZE + GRAPH_MAX_PENDING:
+            _graph_jobs.popitem(last=False)
+    future.add_done_callback(lambda done: _graph_job_done(user_id, done))
+    return "pending"
+
+# Fonction appelée à la fin d'un rendu différé
+def _graph_job_done(user_id, future):
+    with _graph_cache_lock:
+        _graph_pending["count"] -= 1
+    if future.exception() is not None:
+        logging.error(f"Erreur lors de la génération du graphique de l'utilisateur {user_id} : {future.exception()}")
+
+# Fonction pour connaître l'état du graphique d'un utilisateur. Retourne (état, message d'erreur)
+def get_graph_status(user_id):
+    with _graph_cache_lock:
+        job = _graph_jobs.get(user_id)
+        cached = user_id in _graph_cache
+    if job is not None:
+        future = job[1]
+        if not future.done():
+            return "pending", None
+        if future.exception() is not None:
+            return "error", str(future.exception())
+        return "ready", None
+    return ("ready", None) if cached else ("missing", None)
+
 # Fonction pour la visualisation des embeddings
-def plot_user_embeddings(user_id, df_clicks_sample, df_recommandations, embeddings_2D):
+# Le nuage de tous les articles est une image pré-rendue (get_graph_background) sur laquelle sont tracés
+# les points propres à l'utilisateur. L'API objet de Matplotlib (sans pyplot) permet le rendu depuis plusieurs threads.
+def plot_user_embeddings(user_id, user_history, last_article, reco_ids, scores, embeddings_2D):
     logging.info(f"Création de la visualisation des embeddings pour l'utilisateur {user_id}.")
-    user_history, last_article = get_user_history(user_id, df_clicks_sample)
-    reco_ids, _, scores = get_recommendations(user_id, df_clicks_sample, df_recommandations)
-
-    logging.info(f"Historique de l'utilisateur {user_id}: {user_history}, Recommandations: {reco_ids}")
+    if debug_enabled():
+        logging.debug(f"Historique de l'utilisateur {user_id}: {user_history}, Recommandations: {reco_ids}")
 
-    fig, axes = plt.subplots(1, 2, figsize=(15, 6))
+    background, extent = get_graph_background(embeddings_2D)
+    fig = Figure(figsize=(15, 6))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(1, 2)
     fig.suptitle(f"Visualisation des Embeddings et Recommandations pour l'utilisateur {user_id}", fontsize=14, fontweight='bold')
 
-    all_points = embeddings_2D
     user_history_points = embeddings_2D[user_history]
     last_point = embeddings_2D[last_article] if last_article is not None else None
     reco_points = embeddings_2D[reco_ids]
 
     # Graphique 1 : Vue globale
     ax = axes[0]
-    ax.scatter(all_points[:, 0], all_points[:, 1], s=5, color='gray', alpha=0.3, label="Tous les articles")
+    ax.imshow(background, extent=extent, aspect='auto', interpolation='nearest', zorder=0)
+    ax.scatter([], [], s=5, color='gray', alpha=0.3, label="Tous les articles")  # Entrée de légende du fond pré-rendu
     ax.scatter(user_history_points[:, 0], user_history_points[:, 1], color='blue', label="Articles consultés", s=50, alpha=0.6)
     if last_point is not None:
         ax.scatter(last_point[0], last_point[1], color='green', label='Dernier article consulté', s=150, edgecolors='black')
     ax.scatter(reco_points[:, 0], reco_points[:, 1], color='orange', label='Recommandations', s=50, edgecolors='black')
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
     ax.set_title("Vue globale")
     ax.set_xlabel("Composante 1")
     ax.set_ylabel("Composante 2")
@@ -317,11 +2126,10 @@ def plot_user_embeddings(user_id, df_clicks_sample, df_recommandations, embeddin
     ax_zoom.legend()
     ax_zoom.grid(True)
 
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Sauvegarder l'image dans un objet en mémoire pour la réponse
     buf = io.BytesIO()
-    plt.savefig(buf, format="png")
+    fig.savefig(buf, format="png")
     buf.seek(0)  # Revenir au début du buffer
-    plt.close(fig)
     return buf
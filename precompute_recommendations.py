@@ -0,0 +1,198 @@
+"""
+Recalcul hors ligne de la table des recommandations pré-calculées
+
+Le job lit les artefacts colonnaires (voir convert_artifacts.py), construit le profil de chaque utilisateur
+(moyenne des embeddings normalisés de son historique, comme le calcul en ligne de function_app.py) et calcule
+ses top_n articles par produits matriciels par blocs (bloc d'utilisateurs x tranche d'articles), répartis sur
+un pool de processus. La mémoire est bornée par block_size x article_chunk scores par processus, quel que soit
+le nombre d'utilisateurs.
+
+Les résultats sont écrits par shards dans le dossier de sortie :
+    job.json                          -> paramètres du job (une reprise n'est possible qu'avec les mêmes)
+    embeddings_norm.npy               -> embeddings normalisés, partagés en mémoire mappée par les processus
+    shard-00000.<colonne>.npy         -> table CSR d'un shard (user_id, offsets, article_id, similarity_score)
+    manifest.json                     -> écrit à la fin : liste des shards et débit mesuré
+Un shard terminé n'est pas recalculé : relancer la même commande après une interruption reprend le job.
+
+Utilisation :
+    python precompute_recommendations.py artifacts/ reco_shards/ --top-n 10 --workers 4
+Puis définir RECOMMENDATIONS_SHARDS_DIR=reco_shards/ pour que la fonction serve ces recommandations.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from function_app import (RECO_SHARDS_COLUMNS, RECO_SHARDS_MANIFEST, normalize_embeddings, read_artifacts_manifest,
+                          reco_shard_path)
+
+# Données partagées par les processus du pool (ouvertes en mémoire mappée par l'initialiseur)
+_worker = {}
+
+
+def init_worker(version_dir, output):
+    _worker["keys"] = np.load(os.path.join(version_dir, "history_keys.npy"), mmap_mode="r")
+    _worker["offsets"] = np.load(os.path.join(version_dir, "history_offsets.npy"), mmap_mode="r")
+    _worker["articles"] = np.load(os.path.join(version_dir, "history_article_id.npy"), mmap_mode="r")
+    _worker["embeddings_norm"] = np.load(os.path.join(output, "embeddings_norm.npy"), mmap_mode="r")
+
+
+# Fonction pour calculer les profils normalisés d'un bloc d'utilisateurs (positions start:end de l'index)
+def block_profiles(start, end):
+    offsets, embeddings_norm = _worker["offsets"], _worker["embeddings_norm"]
+    history = np.asarray(_worker["articles"][offsets[start]:offsets[end]], dtype=np.int64)
+    valid = (history >= 0) & (history < len(embeddings_norm))  # Articles sans embedding ignorés
+    vectors = embeddings_norm[np.where(valid, history, 0)] * valid[:, None]
+    segments = np.asarray(offsets[start:end], dtype=np.int64) - offsets[start]
+    profiles = np.add.reduceat(vectors, segments, axis=0)
+    norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+    return profiles / np.where(norms == 0, 1.0, norms), history, segments
+
+
+# Fonction pour calculer le top_n d'un bloc d'utilisateurs, tranche d'articles par tranche d'articles
+def score_block(start, end, top_n, article_chunk):
+    embeddings_norm = _worker["embeddings_norm"]
+    profiles, history, segments = block_profiles(start, end)
+    n_users = end - start
+    rows = np.repeat(np.arange(n_users), np.diff(np.append(segments, len(history))))
+    best_ids = np.full((n_users, 0), -1, dtype=np.int64)
+    best_scores = np.full((n_users, 0), -np.inf, dtype=np.float32)
+
+    for chunk_start in range(0, len(embeddings_norm), article_chunk):
+        chunk_end = min(chunk_start + article_chunk, len(embeddings_norm))
+        scores = profiles @ np.asarray(embeddings_norm[chunk_start:chunk_end]).T
+        # Exclure les articles déjà consultés qui tombent dans cette tranche
+        in_chunk = (history >= chunk_start) & (history < chunk_end)
+        scores[rows[in_chunk], history[in_chunk] - chunk_start] = -np.inf
+
+        # Fusion du top_n courant avec le top_n de la tranche
+        k = min(top_n, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        candidate_ids = np.concatenate([best_ids, top + chunk_start], axis=1)
+        candidate_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+        keep = np.argsort(-candidate_scores, axis=1, kind="stable")[:, :top_n]
+        best_ids = np.take_along_axis(candidate_ids, keep, axis=1)
+        best_scores = np.take_along_axis(candidate_scores, keep, axis=1)
+    return best_ids, best_scores
+
+
+# Fonction exécutée par un processus du pool : calcule et écrit un shard (positions start:end de l'index)
+def run_shard(output, shard_id, start, end, top_n, block_size, article_chunk):
+    keys = _worker["keys"]
+    user_ids, article_ids, scores, counts = [], [], [], []
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        best_ids, best_scores = score_block(block_start, block_end, top_n, article_chunk)
+        valid = np.isfinite(best_scores)
+        user_ids.append(np.asarray(keys[block_start:block_end]))
+        article_ids.append(best_ids[valid])
+        scores.append(best_scores[valid])
+        counts.append(valid.sum(axis=1))
+
+    counts = np.concatenate(counts)
+    columns = {
+        "user_id": np.concatenate(user_ids),
+        "offsets": np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        "article_id": np.concatenate(article_ids).astype(np.int32),
+        "similarity_score": np.concatenate(scores).astype(np.float32),
+    }
+    # Écriture via fichiers temporaires : un shard n'existe que s'il est complet
+    for name in RECO_SHARDS_COLUMNS:
+        path = reco_shard_path(output, shard_id, name)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, columns[name], allow_pickle=False)
+    for name in RECO_SHARDS_COLUMNS:
+        path = reco_shard_path(output, shard_id, name)
+        os.replace(path + ".tmp", path)
+    return shard_id, end - start, int(counts.sum())
+
+
+# Fonction pour savoir si un shard a déjà été calculé (reprise après interruption)
+def shard_done(output, shard_id):
+    return all(os.path.exists(reco_shard_path(output, shard_id, name)) for name in RECO_SHARDS_COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recalcul parallèle des recommandations pré-calculées")
+    parser.add_argument("artifacts", help="Dossier des artefacts colonnaires (ARTIFACTS_DIR)")
+    parser.add_argument("output", help="Dossier de sortie des shards (RECOMMENDATIONS_SHARDS_DIR)")
+    parser.add_argument("--top-n", type=int, default=10, help="Nombre de recommandations par utilisateur")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Nombre de processus")
+    parser.add_argument("--users-per-shard", type=int, default=50_000, help="Nombre d'utilisateurs par shard")
+    parser.add_argument("--block-size", type=int, default=64, help="Utilisateurs par produit matriciel")
+    parser.add_argument("--article-chunk", type=int, default=65_536, help="Articles par tranche de produit matriciel")
+    parser.add_argument("--restart", action="store_true", help="Ignorer les shards d'un job précédent")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    manifest = read_artifacts_manifest(args.artifacts)
+    version_dir = os.path.join(args.artifacts, manifest["version"])
+    os.makedirs(args.output, exist_ok=True)
+
+    job = {"artifacts_version": manifest["version"], "top_n": args.top_n, "users_per_shard": args.users_per_shard}
+    job_path = os.path.join(args.output, "job.json")
+    if os.path.exists(job_path) and not args.restart:
+        with open(job_path, encoding="utf-8") as f:
+            previous = json.load(f)
+        if previous != job:
+            parser.error(f"Un job avec d'autres paramètres existe dans {args.output} ({previous}) : utiliser --restart")
+    else:
+        # Nouveau job : les embeddings normalisés d'une version précédente des artefacts sont recalculés aussi
+        for name in os.listdir(args.output):
+            if name.startswith("shard-") or name.startswith("embeddings_norm.") or name == RECO_SHARDS_MANIFEST:
+                os.remove(os.path.join(args.output, name))
+        with open(job_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, indent=2)
+
+    norm_path = os.path.join(args.output, "embeddings_norm.npy")
+    if not os.path.exists(norm_path):
+        embeddings_norm = normalize_embeddings(np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode="r"))
+        np.save(norm_path + ".tmp.npy", embeddings_norm, allow_pickle=False)
+        os.replace(norm_path + ".tmp.npy", norm_path)
+
+    n_users = len(np.load(os.path.join(version_dir, "history_keys.npy"), mmap_mode="r"))
+    shards = [(shard_id, start, min(start + args.users_per_shard, n_users))
+              for shard_id, start in enumerate(range(0, n_users, args.users_per_shard))]
+    todo = [shard for shard in shards if not shard_done(args.output, shard[0])]
+    logging.info(f"{n_users} utilisateurs, {len(shards)} shards dont {len(shards) - len(todo)} déjà calculés")
+    if not todo and os.path.exists(os.path.join(args.output, RECO_SHARDS_MANIFEST)):
+        print(f"Job déjà terminé : {len(shards)} shards dans {args.output}")
+        return
+
+    started, done_users, rows = time.perf_counter(), 0, 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(version_dir, args.output)) as pool:
+        futures = [pool.submit(run_shard, args.output, shard_id, start, end, args.top_n, args.block_size, args.article_chunk)
+                   for shard_id, start, end in todo]
+        for future in as_completed(futures):
+            shard_id, shard_users, shard_rows = future.result()
+            done_users += shard_users
+            rows += shard_rows
+            elapsed = time.perf_counter() - started
+            logging.info(f"Shard {shard_id} terminé : {done_users}/{sum(end - start for _, start, end in todo)} utilisateurs, "
+                         f"{done_users / elapsed:.0f} utilisateurs/s")
+
+    elapsed = time.perf_counter() - started
+    users_per_second = done_users / elapsed if elapsed > 0 else None
+    shards_manifest = {
+        **job,
+        "n_shards": len(shards),
+        "n_users": n_users,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "elapsed_seconds": round(elapsed, 1),
+        "users_per_second": round(users_per_second, 1) if users_per_second else None,
+    }
+    tmp_path = os.path.join(args.output, RECO_SHARDS_MANIFEST + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(shards_manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(args.output, RECO_SHARDS_MANIFEST))
+    print(f"{done_users} utilisateurs calculés en {elapsed:.1f} s ({shards_manifest['users_per_second']} utilisateurs/s), "
+          f"{len(shards)} shards dans {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Accès au stockage des artefacts et des graphiques : Azure Blob Storage ou dossier local
+
+function_app.py ne manipule que l'interface commune (read, get_etag, upload, graph_url), choisie par la variable
+d'environnement STORAGE_BACKEND :
+    - azure (défaut) : clients Azure gardés pour toute la durée du processus (pool de connexions HTTP réutilisé
+      d'une requête à l'autre) ; les gros blobs sont téléchargés par plages, en parallèle (max_concurrency).
+      Les URL publiées des graphiques portent le SAS Token de GRAPHS_SAS_URL.
+    - local : les URL des artefacts sont résolues dans LOCAL_STORAGE_ROOT (https://compte/conteneur/blob ->
+      LOCAL_STORAGE_ROOT/conteneur/blob, chemins relatifs ou absolus, file://) et les fichiers sont mappés en
+      mémoire. Les URL publiées sont LOCAL_STORAGE_URL/conteneur/nom si un serveur de fichiers statiques sert
+      LOCAL_STORAGE_ROOT, sinon des URL file://. Pour les déploiements sur site, les tests et les benchmarks,
+      sans dépendance au cloud.
+"""
+
+import mmap
+import os
+import threading
+from pathlib import Path
+from urllib.parse import quote, unquote, urlsplit
+
+
+class AzureBlobStorage:
+    def __init__(self, connection_string=None, max_concurrency=4, sas_url=None):
+        from azure.storage.blob import BlobClient, BlobServiceClient
+        self._blob_client_class = BlobClient
+        self._service_client_class = BlobServiceClient
+        self.connection_string = connection_string
+        self.max_concurrency = max_concurrency
+        self.sas_url = sas_url  # URL SAS d'un conteneur du compte : fournit le compte et le SAS Token des URL publiées
+        self._blob_clients = {}
+        self._service_client = None
+        self._lock = threading.Lock()
+
+    # Fonction pour récupérer le client (réutilisé) d'un blob désigné par son URL SAS
+    def blob_client(self, url):
+        with self._lock:
+            client = self._blob_clients.get(url)
+            if client is None:
+                client = self._blob_clients[url] = self._blob_client_class.from_blob_url(url)
+            return client
+
+    # Fonction pour récupérer le client (réutilisé) du compte de stockage de la chaîne de connexion
+    def service_client(self):
+        with self._lock:
+            if self._service_client is None:
+                if self.connection_string is None:
+                    raise ValueError("La chaîne de connexion est manquante ou incorrecte")
+                self._service_client = self._service_client_class.from_connection_string(self.connection_string)
+            return self._service_client
+
+    # Fonction pour lire un blob. Retourne (contenu, etag)
+    def read(self, url):
+        download_stream = self.blob_client(url).download_blob(max_concurrency=self.max_concurrency)
+        return download_stream.readall(), download_stream.properties.etag
+
+    # Fonction pour lire uniquement l'ETag d'un blob (requête HEAD, sans téléchargement)
+    def get_etag(self, url):
+        return self.blob_client(url).get_blob_properties().etag
+
+    # Fonction pour écrire un blob dans un conteneur du compte de stockage
+    def upload(self, container, name, data):
+        blob_client = self.service_client().get_blob_client(container=container, blob=name)
+        blob_client.upload_blob(data, overwrite=True, max_concurrency=self.max_concurrency)
+
+    # Fonction pour construire l'URL publique (avec SAS Token si disponible) d'un blob d'un conteneur
+    def graph_url(self, container, name):
+        if self.sas_url:
+            parts = urlsplit(self.sas_url)
+            return f"{parts.scheme}://{parts.netloc}/{container}/{quote(name)}" + (f"?{parts.query}" if parts.query else "")
+        return f"{self.service_client().url.rstrip('/')}/{container}/{quote(name)}"
+
+
+class LocalStorage:
+    def __init__(self, root, base_url=None):
+        self.root = root
+        self.base_url = base_url
+
+    # Fonction pour convertir une URL (ou un chemin) en chemin de fichier local
+    def path(self, url):
+        parts = urlsplit(url)
+        if parts.scheme in ("http", "https"):
+            return os.path.join(self.root, unquote(parts.path).lstrip("/"))
+        if parts.scheme == "file":
+            return unquote(parts.path)
+        return os.path.join(self.root, url)
+
+    # Fonction pour calculer l'ETag d'un fichier (il change à chaque réécriture)
+    @staticmethod
+    def file_etag(path):
+        stat = os.stat(path)
+        return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    # Fonction pour lire un fichier en mémoire mappée (sans copie dans le processus). Retourne (contenu, etag)
+    def read(self, url):
+        path = self.path(url)
+        with open(path, "rb") as f:
+            etag = self.file_etag(path)
+            if os.fstat(f.fileno()).st_size == 0:
+                return b"", etag
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), etag
+
+    # Fonction pour lire uniquement l'ETag d'un fichier
+    def get_etag(self, url):
+        return self.file_etag(self.path(url))
+
+    # Fonction pour écrire un fichier dans root/conteneur/nom (fichier temporaire puis remplacement atomique)
+    def upload(self, container, name, data):
+        path = os.path.join(self.root, container, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    # Fonction pour construire l'URL d'un fichier écrit par upload
+    def graph_url(self, container, name):
+        if self.base_url:
+            return f"{self.base_url.rstrip('/')}/{container}/{quote(name)}"
+        return Path(self.root, container, name).resolve().as_uri()
+
+
+# Fonction pour créer le stockage décrit par les variables d'environnement
+def storage_from_env():
+    backend = os.getenv("STORAGE_BACKEND", "azure")
+    if backend == "azure":
+        return AzureBlobStorage(os.getenv("AzureWebJobsStorage"), int(os.getenv("STORAGE_MAX_CONCURRENCY", "4")),
+                                os.getenv("GRAPHS_SAS_URL"))
+    if backend == "local":
+        return LocalStorage(os.getenv("LOCAL_STORAGE_ROOT", "."), os.getenv("LOCAL_STORAGE_URL"))
+    raise ValueError(f"STORAGE_BACKEND inconnu : {backend} (valeurs possibles : azure, local)")
@@ -0,0 +1,63 @@
+# Tests de la compaction des événements ingérés dans les artefacts colonnaires
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import function_app as fa
+
+
+# Fixture pour servir un petit jeu de données depuis des artefacts colonnaires dans un dossier temporaire
+@pytest.fixture
+def artifacts(tmp_path, monkeypatch):
+    clicks = pd.DataFrame({"user_id": [1, 1, 2, 3], "click_article_id": [0, 1, 2, 3]})
+    recommendations = pd.DataFrame({"user_id": [1, 2], "article_id": [4, 5], "similarity_score": [0.9, 0.8]})
+    embeddings = np.random.default_rng(0).normal(size=(8, 2))
+    fa.write_columnar_artifacts(str(tmp_path), clicks, recommendations, embeddings)
+
+    monkeypatch.setattr(fa, "ARTIFACTS_DIR", str(tmp_path))
+    monkeypatch.setattr(fa, "USER_PARTITIONS_DIR", None)
+    monkeypatch.setattr(fa, "_data_cache", {"data": None, "etags": {}, "version": None, "checked_at": 0.0, "revalidating": False})
+    monkeypatch.setattr(fa, "_ingest_state", {"clicks": [], "articles": {}, "articles_digest": "", "buffers": {},
+                                              "last_compaction": time.monotonic(), "compacting": False})
+    monkeypatch.setattr(fa, "_ingest_stats", dict.fromkeys(fa._ingest_stats, 0))
+    fa.get_data()
+    return tmp_path, clicks, recommendations, embeddings
+
+
+def test_compaction_writes_pending_events(artifacts):
+    directory, *_ = artifacts
+    fa.ingest_events([{"user_id": 3, "click_article_id": 6}], [{"article_id": 8, "embedding": [1.0, 0.0]}])
+
+    assert fa.compact_ingested_events()
+    assert fa.get_ingest_stats()["pending_clicks"] == 0
+    on_disk = fa.load_columnar_artifacts(str(directory))[0]
+    assert 6 in on_disk["index"].user_history(3).tolist()
+    assert len(on_disk["embeddings"]) == 9
+
+
+def test_compaction_rebases_on_artifacts_written_by_another_worker(artifacts, caplog):
+    directory, clicks, recommendations, embeddings = artifacts
+    fa.ingest_events([{"user_id": 1, "click_article_id": 7}], [])
+    # Un autre worker compacte son propre clic après le chargement de ce worker
+    other = pd.concat([clicks, pd.DataFrame({"user_id": [2], "click_article_id": [6]})], ignore_index=True)
+    fa.write_columnar_artifacts(str(directory), other, recommendations, embeddings)
+
+    assert fa.compact_ingested_events()
+    assert "compaction reportée" in caplog.text
+    on_disk = fa.load_columnar_artifacts(str(directory))[0]
+    assert 7 in on_disk["index"].user_history(1).tolist()
+    assert 6 in on_disk["index"].user_history(2).tolist()
+
+
+def test_ingested_events_kept_in_memory_without_artifacts(artifacts, monkeypatch):
+    monkeypatch.setattr(fa, "ARTIFACTS_DIR", None)
+    monkeypatch.setattr(fa, "INGEST_MAX_PENDING_EVENTS", 1)
+
+    assert fa.ingest_events([{"user_id": 1, "click_article_id": 7}], [])["persisted"] is False
+    assert not fa.compact_ingested_events()
+    assert fa.ingest_queue_full()